@@ -0,0 +1,285 @@
+'''
+bam_cache.py - cache the reads of BAM files around utrons
+====================================================
+
+:Author:
+:Tags: Python
+
+Purpose
+-------
+
+.. Extract the reads of BAM files that overlap utrons, and a flank
+   either side of them, into small indexed BAM files, so that the PSO of
+   the utrons can be counted again, or their reads looked at, without
+   reading whole genome BAM files.
+
+The utron BED is read from stdin. The utrons, widened by --flank bases
+either side, are merged into regions, and with --method=slice (the
+default) the reads of each BAM file given overlapping any region are
+written, once each and in position order, to
+<cache-dir>/<hash>/<name of BAM file> and indexed. <hash> is the start
+of the SHA-1 digest of the utron BED, so that the caches of different
+utron sets are kept apart.
+
+Each BAM file sliced is recorded in <cache-dir>/manifest.tsv, keyed by
+the hash of the utron BED and the source BAM file, with the utron BED,
+flank, number of regions and number of reads written. A BAM file is not
+sliced again if it is in the manifest with the same hash and flank, and
+its slice is newer than it.
+
+With --method=lookup, the slices of the BAM files given for the utron
+BED read are written to stdout, one per line, and it is an error if any
+is missing or out of date. Regions also take in the base either side of
+each utron that get_psi.py reads, so get_psi.py counts the same in a
+slice as in the BAM file it was cut from, whatever the flank. Mates
+outside the regions are not kept, so slices are not suited to tools that
+need complete pairs.
+
+Usage
+-----
+
+Example::
+
+   python bam_cache.py -I all_utrons.bed.gz --cache-dir=bam_cache.dir
+                       --processes=4 sorted_bams/*_possorted.bam
+
+   python bam_cache.py --method=lookup -I all_utrons.bed.gz
+                       --cache-dir=bam_cache.dir
+                       sorted_bams/*_possorted.bam > slices.txt &&
+   python get_psi.py -I all_utrons.bed.gz $(cat slices.txt)
+
+The lookup is written to a file first, as the exit status of a command
+substitution is lost, and a failed lookup would otherwise leave out the
+samples it did not find.
+
+Type::
+
+   python bam_cache.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import hashlib
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+import cgatcore.experiment as E
+import pysam
+
+from get_psi import readUtrons
+
+MANIFEST_COLUMNS = ("bed_hash", "utron_bed", "flank", "regions",
+                    "source_bam", "bam", "reads")
+
+# number of hex digits of the SHA-1 digest used to name a cache
+HASH_LENGTH = 16
+
+
+def bedHash(lines):
+    '''The hash of the lines of a utron BED, which names its cache.'''
+
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line.encode())
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def utronRegions(intervals, flank):
+    '''Merge intervals, a list of (contig, start, end), each widened by
+    flank bases either side, into a list of non-overlapping (contig,
+    start, end), sorted by contig and start.'''
+
+    regions = []
+    for contig, start, end in sorted(intervals):
+        # get_psi.py fetches the reads of a utron from a base either side
+        start = max(0, start - flank - 1)
+        end = end + flank + 1
+        if regions and regions[-1][0] == contig and start <= regions[-1][2]:
+            if end > regions[-1][2]:
+                regions[-1] = (contig, regions[-1][1], end)
+        else:
+            regions.append((contig, start, end))
+
+    return regions
+
+
+def sliceBam(bamfile, outfile, regions):
+    '''Write the reads of bamfile overlapping any of regions, as given by
+    :func:`utronRegions`, to outfile and index it. Returns the number of
+    reads written.'''
+
+    reads = 0
+    bam = pysam.AlignmentFile(bamfile)
+    contigs = set(bam.references)
+    tmpfile = outfile + ".tmp"
+    out = pysam.AlignmentFile(tmpfile, "wb", template=bam)
+
+    last_contig = None
+    for contig, start, end in regions:
+        if contig not in contigs:
+            continue
+        if contig != last_contig:
+            last_contig = contig
+            last_end = 0
+        for read in bam.fetch(contig, start, end):
+            # reads starting inside the last region overlapped it, and
+            # have been written already. The rest start after them, so
+            # the slice stays sorted
+            if read.reference_start < last_end:
+                continue
+            out.write(read)
+            reads += 1
+        last_end = end
+
+    out.close()
+    bam.close()
+
+    os.rename(tmpfile, outfile)
+    pysam.index(outfile)
+
+    return reads
+
+
+def readManifest(filename):
+    '''The entries of a manifest, as an OrderedDict of dicts keyed by bed
+    hash and source BAM file.'''
+
+    manifest = OrderedDict()
+    if not os.path.exists(filename):
+        return manifest
+
+    with open(filename) as infile:
+        header = infile.readline().rstrip("\n").split("\t")
+        for line in infile:
+            entry = dict(zip(header, line.rstrip("\n").split("\t")))
+            manifest[(entry["bed_hash"], entry["source_bam"])] = entry
+
+    return manifest
+
+
+def writeManifest(filename, manifest):
+    '''Write the manifest, replacing the file only once it is complete.'''
+
+    with open(filename + ".tmp", "w") as outfile:
+        outfile.write("\t".join(MANIFEST_COLUMNS) + "\n")
+        for entry in manifest.values():
+            outfile.write("\t".join(str(entry[column])
+                                    for column in MANIFEST_COLUMNS) + "\n")
+    os.rename(filename + ".tmp", filename)
+
+
+def isCurrent(entry, flank):
+    '''Is the slice of a manifest entry cut with flank, and newer than
+    the BAM file it was cut from?'''
+
+    return (entry is not None and
+            int(entry["flank"]) == flank and
+            os.path.exists(entry["bam"]) and
+            os.path.getmtime(entry["bam"]) >=
+            os.path.getmtime(entry["source_bam"]))
+
+
+def _sliceSample(task):
+    bamfile, outfile, regions = task
+    return sliceBam(bamfile, outfile, regions)
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=("slice", "lookup"), default="slice",
+                      help="Slice the BAM files given around the utrons "
+                           "(slice), or write the names of their slices "
+                           "(lookup)")
+    parser.add_option("--cache-dir", dest="cache_dir", type="string",
+                      default="bam_cache.dir",
+                      help="Directory holding the manifest and slices")
+    parser.add_option("--flank", dest="flank", type="int", default=1000,
+                      help="Number of bases either side of each utron to "
+                           "keep reads from")
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=1,
+                      help="Number of BAM files to slice at once")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.start(parser, argv=argv)
+
+    if len(args) == 0:
+        raise ValueError("No BAM files given")
+
+    lines = options.stdin.readlines()
+    bed_hash = bedHash(lines)
+    intervals, rows = readUtrons(lines)
+    regions = utronRegions(intervals, options.flank)
+    E.info("Read %i utrons in %i regions, hash %s" % (
+        len(intervals), len(regions), bed_hash))
+
+    cache = os.path.join(options.cache_dir, bed_hash)
+    manifest_file = os.path.join(options.cache_dir, "manifest.tsv")
+    manifest = readManifest(manifest_file)
+
+    if options.method == "lookup":
+        for bamfile in args:
+            entry = manifest.get((bed_hash, os.path.abspath(bamfile)))
+            if not isCurrent(entry, options.flank):
+                raise ValueError("%s has no current slice in %s" %
+                                 (bamfile, cache))
+            options.stdout.write(entry["bam"] + "\n")
+        E.stop()
+        return
+
+    if not os.path.exists(cache):
+        os.makedirs(cache)
+
+    tasks = []
+    for bamfile in args:
+        key = (bed_hash, os.path.abspath(bamfile))
+        if isCurrent(manifest.get(key), options.flank):
+            E.info("%s is already sliced" % bamfile)
+            continue
+        tasks.append((key[1],
+                      os.path.abspath(os.path.join(
+                          cache, os.path.basename(bamfile))),
+                      regions))
+
+    if options.processes > 1 and len(tasks) > 1:
+        pool = multiprocessing.get_context("fork").Pool(options.processes)
+        results = pool.imap(_sliceSample, tasks)
+    else:
+        results = map(_sliceSample, tasks)
+
+    utron_bed = getattr(options.stdin, "name", "stdin")
+    for (bamfile, outfile, task_regions), reads in zip(tasks, results):
+        manifest[(bed_hash, bamfile)] = dict(
+            bed_hash=bed_hash, utron_bed=utron_bed, flank=options.flank,
+            regions=len(regions), source_bam=bamfile, bam=outfile,
+            reads=reads)
+        # the manifest is written after each slice, so that an interrupted
+        # run keeps the slices it finished
+        writeManifest(manifest_file, manifest)
+        E.info("Wrote %i reads of %s to %s" % (reads, bamfile, outfile))
+
+    if options.processes > 1 and len(tasks) > 1:
+        pool.close()
+        pool.join()
+
+    # write footer and output benchmark information.
+    E.stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,443 @@
+'''
+benchmark_find_utrons.py
+====================================================
+
+:Release: $1.0$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+.. Measure the throughput of find_utrons.py on synthetic data.
+
+A reference GTF, an assembly of novel transcripts and a class file
+matching them to reference genes are generated, with a chosen number of
+genes, isoforms per gene, introns per transcript and fraction of novel
+transcripts given an extra intron in their 3' UTR. Loading the
+reference and classifying the novel transcripts are then timed
+separately, each repeat in a fresh process so that its peak resident
+memory can be recorded.
+
+The 3UIs found against the reference parsed from the GTF are also
+compared with those found against the same reference loaded from a
+compiled reference cache, which must be the same.
+
+Results can be saved as a baseline, and later runs compared against it
+to catch performance regressions in the classifier without running it
+on a full assembly.
+
+Usage
+-----
+
+Example::
+
+   python benchmark_find_utrons.py --genes=5000 --save-baseline=baseline.json
+
+   # after changing find_utrons.py
+   python benchmark_find_utrons.py --baseline=baseline.json
+
+The baseline records the parameters used to generate the data, which are
+reused when comparing to it. The comparison is written to stdout, and
+the script exits with a non-zero status if any measure is worse than the
+baseline by more than --tolerance, or if the cached reference differs.
+
+Type::
+
+   python benchmark_find_utrons.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import sys
+import os
+import json
+import random
+import resource
+import shutil
+import tempfile
+import time
+import multiprocessing
+from collections import Counter, OrderedDict
+from cgatcore import experiment as E
+import cgatcore.iotools as IOTools
+
+
+# the parameters of the synthetic data, and their defaults
+PARAMETERS = OrderedDict((("genes", 2000),
+                          ("isoforms", 3),
+                          ("introns", 6),
+                          ("utron_rate", 0.3),
+                          ("seed", 1)))
+
+# the measures compared to a baseline. Larger is worse for all of them.
+MEASURES = ("reference_seconds", "classify_seconds", "peak_rss_mb")
+
+
+def _gtfLine(contig, feature, start, end, strand, gene_id, transcript_id,
+             frame=".", attributes=""):
+    return ('%s\tsynthetic\t%s\t%i\t%i\t.\t%s\t%s\t'
+            'gene_id "%s"; transcript_id "%s";%s\n' % (
+                contig, feature, start + 1, end, strand, frame, gene_id,
+                transcript_id, attributes))
+
+
+def _transcriptLines(contig, strand, gene_id, transcript_id, exons,
+                     cds=None):
+    '''GTF lines for a transcript with 0-based, half-open exons and,
+    optionally, the bounds of its CDS.'''
+
+    lines = [_gtfLine(contig, "exon", start, end, strand, gene_id,
+                      transcript_id)
+             for start, end in exons]
+
+    if cds is None:
+        return lines
+
+    cds_start, cds_end = cds
+    protein = ' protein_id "%s";' % transcript_id.replace("T", "P", 1)
+    for start, end in exons:
+        if min(end, cds_end) > max(start, cds_start):
+            lines.append(_gtfLine(contig, "CDS", max(start, cds_start),
+                                  min(end, cds_end), strand, gene_id,
+                                  transcript_id, "0", protein))
+
+    if strand == "+":
+        lines.append(_gtfLine(contig, "start_codon", cds_start,
+                              cds_start + 3, strand, gene_id,
+                              transcript_id, "0"))
+    else:
+        lines.append(_gtfLine(contig, "start_codon", cds_end - 3, cds_end,
+                              strand, gene_id, transcript_id, "0"))
+
+    return lines
+
+
+def _addUtron(exons, strand, rng):
+    '''Split the terminal 3' exon of a transcript to give it a new 3' UTR
+    intron.'''
+
+    if strand == "+":
+        start, end = exons[-1]
+        donor = start + rng.randint(200, 1500)
+        return exons[:-1] + [(start, donor), (donor + rng.randint(100, 800),
+                                              end)]
+    else:
+        start, end = exons[0]
+        acceptor = end - rng.randint(200, 1500)
+        return [(start, acceptor - rng.randint(100, 800)),
+                (acceptor, end)] + exons[1:]
+
+
+def generateDataset(outdir, genes, isoforms, introns, utron_rate, seed):
+    '''Write a synthetic reference GTF, novel GTF and class file to
+    outdir, returning their file names.
+
+    Each gene has a coding model with introns + 1 exons and a long 3' UTR
+    in its last exon, and isoforms - 1 further coding models that skip
+    one internal exon each. Each model is copied into the novel
+    assembly, and a utron_rate fraction of the copies are given an extra
+    3' UTR intron. Five percent of novel transcripts are left without a
+    matched gene in the class file.'''
+
+    rng = random.Random(seed)
+
+    reffile = os.path.join(outdir, "reference.gtf.gz")
+    novelfile = os.path.join(outdir, "novel.gtf.gz")
+    classfile = os.path.join(outdir, "novel.class.tsv.gz")
+
+    ref = IOTools.open_file(reffile, "w")
+    novel = IOTools.open_file(novelfile, "w")
+    classes = IOTools.open_file(classfile, "w")
+    classes.write("transcript_id\tgene_id\tmatch_gene_id\n")
+
+    position = 10000
+    for gene in range(genes):
+        contig = "chr%i" % (gene % 22 + 1)
+        strand = rng.choice("+-")
+        gene_id = "ENSGSYN%07i" % gene
+
+        exons = []
+        start = position
+        for exon in range(introns + 1):
+            end = start + rng.randint(80, 300)
+            exons.append((start, end))
+            start = end + rng.randint(300, 5000)
+
+        # a long terminal exon holding the 3' UTR
+        if strand == "+":
+            exons[-1] = (exons[-1][0], exons[-1][0] + 3000)
+            cds = (exons[0][0] + 20, exons[-1][0] + 60)
+        else:
+            exons[0] = (exons[0][1] - 3000, exons[0][1])
+            cds = (exons[0][1] - 60, exons[-1][1] - 20)
+
+        position = exons[-1][1] + 20000
+
+        models = [exons]
+        for isoform in range(1, isoforms):
+            skipped = 1 + (isoform - 1) % max(1, len(exons) - 2)
+            if skipped < len(exons) - 1:
+                models.append(exons[:skipped] + exons[skipped + 1:])
+            else:
+                models.append(exons)
+
+        novel_gene_id = "MSTRG.%i" % gene
+        for isoform, model in enumerate(models):
+            ref.writelines(_transcriptLines(
+                contig, strand, gene_id,
+                "ENSTSYN%07i.%i" % (gene, isoform), model, cds))
+
+            if rng.random() < utron_rate:
+                model = _addUtron(model, strand, rng)
+
+            transcript_id = "%s.%i" % (novel_gene_id, isoform)
+            novel.writelines(_transcriptLines(
+                contig, strand, novel_gene_id, transcript_id, model))
+
+            if rng.random() < 0.05:
+                classes.write("%s\t%s\t\n" % (transcript_id, novel_gene_id))
+            else:
+                classes.write("%s\t%s\t%s\n" % (transcript_id,
+                                                 novel_gene_id, gene_id))
+
+    for outf in (ref, novel, classes):
+        outf.close()
+
+    return reffile, novelfile, classfile
+
+
+def _measure(reffile, novelfile, classfile):
+    '''Load the reference and classify the novel transcripts, returning
+    the time taken by each and the peak resident memory of the process.
+    Run in a fresh process for each repeat.'''
+
+    import cgat.GTF as GTF
+    import find_utrons
+
+    start = time.time()
+    reference = find_utrons.getGeneTable(reffile)
+    reference_seconds = time.time() - start
+
+    start = time.time()
+    classes = find_utrons.loadClassTable(classfile)
+    transcripts = GTF.transcript_iterator(
+        GTF.iterator(IOTools.open_file(novelfile)))
+    counts = Counter()
+    find_utrons.find_utrons(reference, classes, transcripts, counts=counts)
+    classify_seconds = time.time() - start
+
+    # kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return OrderedDict((("reference_seconds", reference_seconds),
+                        ("classify_seconds", classify_seconds),
+                        ("peak_rss_mb", peak_rss / 1024.0),
+                        ("transcripts", counts["transcripts"]),
+                        ("with_3ui", counts["with_3ui"])))
+
+
+def checkReferenceCache(reffile, novelfile, classfile):
+    '''Classify the novel transcripts against the reference parsed from
+    the GTF and against the same reference written to and loaded from a
+    compiled reference cache. Returns the parts of the splice site index
+    and the categories of 3UI that differ between the two.'''
+
+    import cgat.GTF as GTF
+    import find_utrons
+
+    cache_dir = tempfile.mkdtemp()
+    try:
+        fresh = find_utrons.getGeneTable(reffile)
+        find_utrons.getGeneTable(reffile, cache_dir)
+        cached = find_utrons.getGeneTable(reffile, cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
+
+    differences = [name for name in ("intron_starts", "intron_ends",
+                                     "cds_intron_starts", "cds_intron_ends")
+                   if getattr(fresh[1], name) != getattr(cached[1], name)]
+
+    utrons = []
+    for reference in (fresh, cached):
+        classes = find_utrons.loadClassTable(classfile)
+        transcripts = GTF.transcript_iterator(
+            GTF.iterator(IOTools.open_file(novelfile)))
+        utrons.append(find_utrons.find_utrons(reference, classes,
+                                              transcripts))
+
+    differences.extend(category for category in utrons[0]
+                       if not utrons[0][category].equals(
+                           utrons[1][category]))
+
+    return differences
+
+
+def runBenchmark(reffile, novelfile, classfile, repeats):
+    '''Measure find_utrons repeats times, returning the fastest time for
+    each stage and the largest peak memory.'''
+
+    context = multiprocessing.get_context("spawn")
+    runs = []
+    for repeat in range(repeats):
+        with context.Pool(1) as pool:
+            runs.append(pool.apply(_measure,
+                                   (reffile, novelfile, classfile)))
+        E.info("Repeat %i: %s" % (repeat + 1, json.dumps(runs[-1])))
+
+    results = OrderedDict()
+    for measure in runs[0]:
+        if measure == "peak_rss_mb":
+            results[measure] = max(run[measure] for run in runs)
+        else:
+            results[measure] = min(run[measure] for run in runs)
+
+    results["transcripts_per_second"] = (results["transcripts"] /
+                                         results["classify_seconds"])
+    return results
+
+
+def compareToBaseline(results, baseline, tolerance, outfile):
+    '''Write a table comparing results to a baseline. Returns the
+    measures that are worse than the baseline by more than tolerance.'''
+
+    outfile.write("measure\tbaseline\tcurrent\tratio\tstatus\n")
+    regressions = []
+    for measure in MEASURES:
+        ratio = results[measure] / baseline[measure]
+        if ratio > 1 + tolerance:
+            status = "worse"
+            regressions.append(measure)
+        elif ratio < 1 - tolerance:
+            status = "better"
+        else:
+            status = "same"
+        outfile.write("%s\t%.3f\t%.3f\t%.3f\t%s\n" % (
+            measure, baseline[measure], results[measure], ratio, status))
+
+    # a change in output is a bug rather than a regression, so is
+    # reported but not tolerated
+    for measure in ("transcripts", "with_3ui"):
+        if results[measure] != baseline[measure]:
+            E.warn("%s differs from the baseline: %i, not %i" % (
+                measure, results[measure], baseline[measure]))
+            regressions.append(measure)
+
+    return regressions
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $1.0$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--genes", dest="genes", type="int",
+                      help="Number of genes in the reference")
+    parser.add_option("--isoforms", dest="isoforms", type="int",
+                      help="Number of coding isoforms per gene")
+    parser.add_option("--introns", dest="introns", type="int",
+                      help="Number of introns in the longest isoform of "
+                           "each gene")
+    parser.add_option("--utron-rate", dest="utron_rate", type="float",
+                      help="Fraction of novel transcripts with an extra "
+                           "3' UTR intron")
+    parser.add_option("--seed", dest="seed", type="int",
+                      help="Random seed for the synthetic data")
+    parser.add_option("--repeats", dest="repeats", type="int", default=3,
+                      help="Number of times to repeat the measurement. The "
+                           "fastest time is reported")
+    parser.add_option("--data-dir", dest="data_dir", type="string",
+                      help="Directory to write the synthetic data to. It is "
+                           "written to a temporary directory and removed if "
+                           "not given")
+    parser.add_option("--save-baseline", dest="save_baseline", type="string",
+                      help="Save the parameters and results to this file")
+    parser.add_option("--baseline", dest="baseline", type="string",
+                      help="Compare results to a baseline saved with "
+                           "--save-baseline, using its parameters")
+    parser.add_option("--tolerance", dest="tolerance", type="float",
+                      default=0.2,
+                      help="Fraction by which a measure can be worse than "
+                           "the baseline before it is reported as a "
+                           "regression")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.start(parser, argv=argv)
+
+    if options.baseline is not None:
+        with IOTools.open_file(options.baseline) as inf:
+            baseline = json.load(inf, object_pairs_hook=OrderedDict)
+        parameters = baseline["parameters"]
+    else:
+        baseline = None
+        parameters = OrderedDict(PARAMETERS)
+
+    for parameter in PARAMETERS:
+        if getattr(options, parameter) is not None:
+            if baseline is not None and \
+               getattr(options, parameter) != parameters[parameter]:
+                E.warn("%s differs from the baseline" % parameter)
+            parameters[parameter] = getattr(options, parameter)
+
+    E.info("Parameters: %s" % json.dumps(parameters))
+
+    if options.data_dir is not None:
+        data_dir = options.data_dir
+        os.makedirs(data_dir, exist_ok=True)
+    else:
+        data_dir = tempfile.mkdtemp()
+
+    start = time.time()
+    files = generateDataset(data_dir, **parameters)
+    E.info("Generated data in %.1f seconds" % (time.time() - start))
+
+    results = runBenchmark(*files, repeats=options.repeats)
+
+    # a cached reference must classify exactly as a freshly parsed one
+    cache_differences = checkReferenceCache(*files)
+    if cache_differences:
+        E.warn("The compiled reference cache differs from the GTF in %s" %
+               ", ".join(cache_differences))
+
+    if options.data_dir is None:
+        shutil.rmtree(data_dir)
+
+    if options.save_baseline is not None:
+        with IOTools.open_file(options.save_baseline, "w") as outf:
+            json.dump(OrderedDict((("parameters", parameters),
+                                   ("results", results))),
+                      outf, indent=2)
+            outf.write("\n")
+
+    if baseline is not None:
+        regressions = compareToBaseline(results, baseline["results"],
+                                        options.tolerance, options.stdout)
+    else:
+        regressions = []
+        options.stdout.write("measure\tvalue\n")
+        for measure, value in results.items():
+            options.stdout.write("%s\t%s\n" % (measure, value))
+
+    # write footer and output benchmark information.
+    E.stop()
+
+    if cache_differences:
+        regressions.append("reference_cache")
+
+    if regressions:
+        E.warn("Regressions in %s" % ", ".join(regressions))
+        return 1
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
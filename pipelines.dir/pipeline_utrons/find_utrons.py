@@ -27,48 +27,1504 @@ Type::
 
 for command line help.
 
+The classification can also be run from python, returning tables rather
+than writing BED files::
+
+   import cgat.GTF as GTF
+   import find_utrons
+
+   reference = find_utrons.getGeneTable("reference.gtf.gz")
+   classes = find_utrons.loadClassTable("assembly.class.gz")
+   transcripts = GTF.transcript_iterator(GTF.iterator(infile))
+   tables = find_utrons.find_utrons(reference, classes, transcripts)
+   tables["novel"]
+
 Command line options
 --------------------
 
 '''
 
 import sys
+import os
+import hashlib
+import functools
+import pickle
+import io
+import multiprocessing
+import copy
+import heapq
+import tempfile
+import time
+import json
+import contextlib
 from cgatcore import experiment as E
 import cgat.GTF as GTF
 import cgat.Bed as Bed
+import cgat.Intervals as Intervals
 import cgatcore.iotools as IOTools
 import itertools
+import bisect
 from cgatcore import database as Database
-from collections import defaultdict, OrderedDict
-import pandas
+from collections import defaultdict, OrderedDict, ChainMap, Counter
+from splice_site_index import SpliceSiteIndex, gtfAttribute
+
+
+# bump when the layout of the compiled reference changes, so that stale
+# caches are rebuilt rather than misread
+REFERENCE_CACHE_VERSION = 2
+
+
+# shared by the many models without CDS or 3' UTR introns
+NO_INTRONS = frozenset()
+
+
+class TranscriptModel(object):
+    '''A compiled reference transcript. Intervals are 0-based, half-open
+    (start, end) tuples. exons and cds hold the bounds of the transcript
+    and its coding region, or cds is None for a non-coding transcript.
+    cds_features holds the (source, start, end, score, frame) of each CDS
+    line, from which GTF entries are only made when a CDS is copied to a
+    novel transcript (see :func:`formatPartners`).'''
+
+    __slots__ = ("contig", "strand", "introns", "exons", "cds",
+                 "start_codon", "cds_introns", "utr3_introns",
+                 "cds_features", "protein_id")
+
+    def cdsEntries(self, gene_id, transcript_id, attributes):
+        '''GTF entries for the CDS of this model, labelled as belonging to
+        gene_id and transcript_id and given attributes.'''
+
+        entries = []
+        for source, start, end, score, frame in self.cds_features:
+            entry = GTF.Entry()
+            entry.contig = self.contig
+            entry.source = source
+            entry.feature = "CDS"
+            entry.start = start
+            entry.end = end
+            entry.score = score
+            entry.strand = self.strand
+            entry.frame = frame
+            entry.gene_id = gene_id
+            entry.transcript_id = transcript_id
+            entry.attributes = attributes
+            entries.append(entry)
+
+        return entries
+
+
+def buildModel(contig, strand, introns, exons, cds, start_codon,
+               cds_features, protein_id):
+    '''Build the compiled record for one reference transcript from its
+    introns, exon and CDS bounds. Everything the classifier asks about a
+    model is derived here once, rather than once per novel transcript
+    compared against it.'''
+
+    model = TranscriptModel()
+    model.contig = sys.intern(contig)
+    model.strand = sys.intern(strand)
+    model.introns = tuple(introns)
+    model.exons = exons
+    model.cds = cds
+    model.start_codon = start_codon
+    model.cds_introns = NO_INTRONS
+    model.utr3_introns = NO_INTRONS
+    model.cds_features = tuple((sys.intern(source), start, end, score, frame)
+                               for source, start, end, score, frame in
+                               cds_features)
+    model.protein_id = protein_id
+
+    if cds is None:
+        return model
+
+    cds_start, cds_end = cds
+    cds_introns = frozenset(intron for intron in introns if
+                            (intron[0] > cds_start and
+                             intron[1] < cds_end))
+
+    utr_introns = [intron for intron in introns if
+                   intron not in cds_introns]
+    if strand == "+":
+        utr3_introns = [intron for intron in utr_introns if
+                        intron[0] >= cds_end and
+                        intron[1] < exons[1]]
+    else:
+        utr3_introns = [intron for intron in utr_introns if
+                        intron[1] <= cds_start and
+                        intron[0] > exons[0]]
+
+    if cds_introns:
+        model.cds_introns = cds_introns
+    if utr3_introns:
+        model.utr3_introns = frozenset(utr3_introns)
+
+    return model
+
+
+def transcriptStructure(transcript):
+    '''The merged, sorted exons and the introns of a transcript given as
+    a list of GTF entries. These are the intervals returned by
+    GTF.asRanges(transcript, "exon") and GTF.toIntronIntervals, from a
+    single pass over the entries.'''
+
+    exons = Intervals.combine([(x.start, x.end) for x in transcript
+                               if x.feature == "exon"])
+    introns = [(exons[i - 1][1], exons[i][0]) for i in range(1, len(exons))]
+    return exons, introns
+
+
+def compileModel(transcript):
+    '''Compile a reference transcript, given as a list of GTF entries.
+    Only the coordinates are kept, and the protein_id of the CDS.'''
+
+    exons, introns = transcriptStructure(transcript)
+
+    cds_features = []
+    start_codons = []
+    for entry in transcript:
+        if entry.feature == "CDS":
+            cds_features.append(entry)
+        elif entry.feature == "start_codon":
+            start_codons.append(entry)
+
+    if len(start_codons) == 0:
+        start_codon = None
+    elif transcript[0].strand == "-":
+        start_codon = max(e.end for e in start_codons)
+    else:
+        start_codon = min(e.start for e in start_codons)
+
+    if len(cds_features) > 0:
+        cds = (min(e.start for e in cds_features),
+               max(e.end for e in cds_features))
+    else:
+        cds = None
+
+    if len(cds_features) > 0 and "protein_id" in cds_features[0].attributes:
+        protein_id = sys.intern(cds_features[0].protein_id)
+    else:
+        protein_id = None
+
+    return buildModel(transcript[0].contig,
+                      transcript[0].strand,
+                      introns,
+                      (exons[0][0], exons[-1][1]) if exons else None,
+                      cds,
+                      start_codon,
+                      [(x.source, x.start, x.end, x.score, x.frame)
+                       for x in cds_features],
+                      protein_id)
+
+
+def indexGene(gene_id, models):
+    '''Build a gene record from its compiled models: the models that use
+    each start codon and the coding models indexed by CDS bounds and CDS
+    intron chain.'''
+
+    gene = {"gene_id": gene_id,
+            "models": models,
+            "start_codons": defaultdict(list),
+            "cds_chains": defaultdict(set)}
+
+    for transcript_id, model in models.items():
+        if model.start_codon is not None:
+            gene["start_codons"][model.start_codon].append(transcript_id)
+
+        if model.cds is not None:
+            gene["cds_chains"][(model.cds, model.cds_introns)].add(
+                transcript_id)
+
+    return gene
+
+
+@functools.lru_cache()
+def referenceDigest(reffile):
+    '''SHA1 of the content of reffile. Compiled and memoised results are
+    keyed on this rather than on the name or timestamp of the reference,
+    so that jobs on different nodes using the same reference share
+    them.'''
+
+    digest = hashlib.sha1()
+    with open(reffile, "rb") as inf:
+        for chunk in iter(lambda: inf.read(1 << 20), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def referenceCacheFile(reffile, cache_dir):
+    '''Name of the compiled reference cache for reffile'''
+
+    return os.path.join(cache_dir, "%s.v%i.reference.arrow" %
+                        (referenceDigest(reffile), REFERENCE_CACHE_VERSION))
+
 
+def spliceSiteCacheFile(cache_file):
+    '''Name of the splice site index stored with the compiled reference
+    cache_file'''
+
+    if cache_file.endswith(".reference.arrow"):
+        cache_file = cache_file[:-len(".reference.arrow")]
+    return cache_file + ".splice_sites.arrow"
+
+
+def _writeArrow(arrow_table, filename):
+    '''Write arrow_table as an uncompressed Arrow IPC file. It is written
+    to a temporary name and moved into place, so that concurrent jobs never
+    see a partially written file.'''
+
+    import pyarrow as pa
+
+    tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+    with pa.OSFile(tmp_file, "wb") as sink:
+        with pa.ipc.new_file(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+    os.replace(tmp_file, filename)
+
+
+def saveReferenceCache(table, cache_file, splice_sites):
+    '''Write the compiled reference as an uncompressed Arrow IPC file,
+    one row per model, so that it can be memory mapped on loading.
+
+    The :class:`SpliceSiteIndex` of the reference is written alongside
+    it (see :func:`spliceSiteCacheFile`), one row per contig and strand,
+    so that loading the index does not need the models of every gene.'''
+
+    import pyarrow as pa
+
+    sites = defaultdict(list)
+    for (contig, strand, starts, ends,
+         cds_starts, cds_ends) in splice_sites.iterateSites():
+        sites["contig"].append(contig)
+        sites["strand"].append(strand)
+        sites["intron_starts"].append(sorted(starts))
+        sites["intron_ends"].append(sorted(ends))
+        sites["cds_intron_starts"].append(sorted(cds_starts))
+        sites["cds_intron_ends"].append(sorted(cds_ends))
+
+    sites_schema = pa.schema([("contig", pa.string()),
+                              ("strand", pa.string()),
+                              ("intron_starts", pa.list_(pa.int64())),
+                              ("intron_ends", pa.list_(pa.int64())),
+                              ("cds_intron_starts", pa.list_(pa.int64())),
+                              ("cds_intron_ends", pa.list_(pa.int64()))])
+
+    # the index is written first, so that a complete reference cache
+    # always has its index
+    _writeArrow(pa.Table.from_pydict(sites, schema=sites_schema),
+                spliceSiteCacheFile(cache_file))
+
+    columns = defaultdict(list)
+    for geneid, gene in table.items():
+        for transcript_id, model in gene["models"].items():
+            columns["gene_id"].append(geneid)
+            columns["transcript_id"].append(transcript_id)
+            columns["contig"].append(model.contig)
+            columns["strand"].append(model.strand)
+            columns["intron_starts"].append([i[0] for i in model.introns])
+            columns["intron_ends"].append([i[1] for i in model.introns])
+            columns["exons"].append(model.exons)
+            columns["cds"].append(model.cds)
+            columns["start_codon"].append(model.start_codon)
+            columns["protein_id"].append(model.protein_id)
+            sources, starts, ends, scores, frames = (
+                zip(*model.cds_features) if model.cds_features
+                else ((), (), (), (), ()))
+            columns["cds_sources"].append(list(sources))
+            columns["cds_starts"].append(list(starts))
+            columns["cds_ends"].append(list(ends))
+            columns["cds_scores"].append(list(scores))
+            columns["cds_frames"].append(
+                [None if frame is None else str(frame) for frame in frames])
+
+    schema = pa.schema([("gene_id", pa.string()),
+                        ("transcript_id", pa.string()),
+                        ("contig", pa.string()),
+                        ("strand", pa.string()),
+                        ("intron_starts", pa.list_(pa.int64())),
+                        ("intron_ends", pa.list_(pa.int64())),
+                        ("exons", pa.list_(pa.int64(), 2)),
+                        ("cds", pa.list_(pa.int64(), 2)),
+                        ("start_codon", pa.int64()),
+                        ("protein_id", pa.string()),
+                        ("cds_sources", pa.list_(pa.string())),
+                        ("cds_starts", pa.list_(pa.int64())),
+                        ("cds_ends", pa.list_(pa.int64())),
+                        ("cds_scores", pa.list_(pa.float64())),
+                        ("cds_frames", pa.list_(pa.string()))])
+
+    _writeArrow(pa.Table.from_pydict(columns, schema=schema), cache_file)
+
+
+def loadReferenceCache(cache_file, gene_ids=None):
+    '''Load a compiled reference written by :func:`saveReferenceCache`.
+    If gene_ids is given, only the models of those genes are read from the
+    mapped file. The splice site index of the whole reference is read from
+    its own file, without reading the models. Returns the table and the
+    index.'''
+
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    with pa.memory_map(spliceSiteCacheFile(cache_file), "r") as source:
+        sites = pa.ipc.open_file(source).read_all().to_pydict()
+
+    splice_sites = SpliceSiteIndex()
+    for row in zip(*(sites[name] for name in
+                     ("contig", "strand", "intron_starts", "intron_ends",
+                      "cds_intron_starts", "cds_intron_ends"))):
+        splice_sites.addSites(*row)
+
+    with pa.memory_map(cache_file, "r") as source:
+        arrow_table = pa.ipc.open_file(source).read_all()
+
+        if gene_ids is not None:
+            arrow_table = arrow_table.filter(
+                pc.is_in(arrow_table["gene_id"],
+                         value_set=pa.array(sorted(gene_ids), pa.string())))
+        columns = arrow_table.to_pydict()
+
+    models = defaultdict(dict)
+    for row in zip(*(columns[name] for name in
+                     ("gene_id", "transcript_id", "contig", "strand",
+                      "intron_starts", "intron_ends", "exons", "cds",
+                      "start_codon", "protein_id", "cds_sources",
+                      "cds_starts", "cds_ends", "cds_scores",
+                      "cds_frames"))):
+
+        (geneid, transcript_id, contig, strand, intron_starts, intron_ends,
+         exons, cds, start_codon, protein_id, cds_sources, cds_starts,
+         cds_ends, cds_scores, cds_frames) = row
+
+        models[sys.intern(geneid)][sys.intern(transcript_id)] = buildModel(
+            contig,
+            strand,
+            list(zip(intron_starts, intron_ends)),
+            tuple(exons) if exons is not None else None,
+            tuple(cds) if cds is not None else None,
+            start_codon,
+            zip(cds_sources, cds_starts, cds_ends, cds_scores, cds_frames),
+            sys.intern(protein_id) if protein_id is not None else None)
+
+    table = defaultdict(dict)
+    for geneid, gene_models in models.items():
+        table[geneid] = indexGene(geneid, gene_models)
+
+    return table, splice_sites
+
+
+def _geneId(line):
+    '''Get the gene_id from the text of a GTF line without parsing it'''
+    return gtfAttribute(line, "gene_id")
+
+
+def iterateGenes(reffile, gene_ids=None):
+    '''Iterate over the genes in reffile. If gene_ids is given, lines
+    belonging to other genes are dropped before they are parsed.'''
+
+    if gene_ids is None:
+        return GTF.gene_iterator(GTF.iterator(IOTools.open_file(reffile)))
+
+    wanted = io.StringIO()
+    with IOTools.open_file(reffile) as inf:
+        for line in inf:
+            if _geneId(line) in gene_ids:
+                wanted.write(line)
+    wanted.seek(0)
+
+    return GTF.gene_iterator(GTF.iterator(wanted))
+
+
+def getGeneTable(reffile, cache_dir=None, gene_ids=None):
+    '''Load the reference into a per-gene table of compiled models (see
+    :func:`indexGene`).
+
+    If cache_dir is given, the compiled reference is read from the cache
+    for this reference if there is one, and written there if not.
+
+    If gene_ids is given, only those genes are loaded. A cache is still
+    built from the whole reference, so that it can be shared by runs
+    that need different genes.
+
+    Returns the table and a :class:`SpliceSiteIndex` of the whole
+    reference, whichever genes are loaded.'''
 
-def getGeneTable(reffile):
     E.info("Loading reference")
+
+    if cache_dir is not None:
+        cache_file = referenceCacheFile(reffile, cache_dir)
+        if (os.path.exists(cache_file) and
+                os.path.exists(spliceSiteCacheFile(cache_file))):
+            E.info("Using compiled reference %s" % cache_file)
+            table, splice_sites = loadReferenceCache(cache_file, gene_ids)
+            E.info("Reference Loaded: %i genes" % len(table))
+            E.info("Splice site index: %i intron starts" % len(splice_sites))
+            return table, splice_sites
+
+    if cache_dir is not None:
+        genes = iterateGenes(reffile)
+    else:
+        genes = iterateGenes(reffile, gene_ids)
+
+    # genes that are not loaded still have their splice sites indexed
+    if cache_dir is None and gene_ids is not None:
+        with IOTools.open_file(reffile) as inf:
+            splice_sites = SpliceSiteIndex.fromGTF(inf)
+        index_models = False
+    else:
+        splice_sites = SpliceSiteIndex()
+        index_models = True
+
     table = defaultdict(dict)
-    for ens_gene in GTF.gene_iterator(GTF.iterator(IOTools.open_file(reffile))):
-        geneid = ens_gene[0][0].gene_id
-        table[geneid]["models"] = dict()
-        table[geneid]["start_codons"] = defaultdict(list)
+    for ens_gene in genes:
+        geneid = sys.intern(ens_gene[0][0].gene_id)
+        models = OrderedDict((sys.intern(transcript[0].transcript_id),
+                              compileModel(transcript))
+                             for transcript in ens_gene)
+        if index_models:
+            for model in models.values():
+                splice_sites.add(model.contig, model.strand,
+                                 model.introns, model.cds)
+        table[geneid] = indexGene(geneid, models)
+
+    if cache_dir is not None:
+        E.info("Writing compiled reference to %s" % cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        saveReferenceCache(table, cache_file, splice_sites)
+
+        if gene_ids is not None:
+            table = defaultdict(dict, ((geneid, table[geneid])
+                                       for geneid in table
+                                       if geneid in gene_ids))
+
+    E.info("Reference Loaded: %i genes" % len(table))
+    E.info("Splice site index: %i intron starts" % len(splice_sites))
+    return table, splice_sites
+
+
+def _in_exon(position, exons, exon_starts):
+    '''Is position inside one of the sorted, non-overlapping exons?'''
+    i = bisect.bisect_right(exon_starts, position) - 1
+    return i >= 0 and position <= exons[i][1]
+
+
+# values that pandas, and so the rest of the pipeline, reads as missing
+NA_VALUES = frozenset(["", "NA", "na", "N/A", "n/a", "<NA>", "nan", "NaN",
+                       "None", "NULL", "null"])
+
+
+def loadClassTable(classfile):
+    '''Read the transcript_id and match_gene_id columns of a gtf2table
+    class file into a dict. Missing matches map to None. Gene ids are
+    interned, as many transcripts share each one. If a transcript
+    appears more than once, its first row is used.'''
+
+    E.info("Loading class table")
+    table = dict()
+    with IOTools.open_file(classfile) as inf:
+        header = inf.readline().rstrip("\n").split("\t")
+        transcript_col = header.index("transcript_id")
+        gene_col = header.index("match_gene_id")
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            transcript_id = fields[transcript_col]
+            if transcript_id in table:
+                continue
+            geneid = fields[gene_col]
+            if geneid in NA_VALUES:
+                table[transcript_id] = None
+            else:
+                table[transcript_id] = sys.intern(geneid)
+
+    E.info("Class table loaded: %i transcripts" % len(table))
+    return table
+
+
+# the output streams of the classifier, in the order in which
+# classifyTranscript returns them
+OUTPUTS = ("all", "individual", "partnered", "individual_partnered",
+           "novel", "no_cds", "gtf", "table")
+
+# the streams that are BED files, which can be written indexed
+BED_OUTPUTS = OUTPUTS[:6]
+
+# the 3UI categories returned by find_utrons and written to the table
+# stream, and the partners field with the introns of each. "all" and
+# "partnered" hold the introns written to both the transcript and
+# individual intron BED files.
+UTRON_CATEGORIES = (("all", 2),
+                    ("partnered", 3),
+                    ("novel", 4),
+                    ("no_cds", 5))
+
+UTRON_COLUMNS = ("contig", "start", "end", "strand", "transcript_id",
+                 "match_transcript_id", "ens_stop")
+
+# the columns of the table stream, which holds every 3UI with the
+# reference transcript it was found against, so that the partners of a
+# transcript can be read back by loadProjection
+TABLE_COLUMNS = ("transcript_id", "match_gene_id", "match_transcript_id",
+                 "ens_stop", "category", "contig", "start", "end", "strand")
+
+
+# what is counted for each transcript, and for each comparison of a
+# transcript to a reference model, in the order they are summarised.
+# "transcripts" are those compared to the reference, which excludes
+# those "projected" from another assembly. Comparisons are only counted
+# when they are made, not for "memoised" transcripts.
+COUNTERS = ("transcripts",
+            "not_in_class_table",
+            "no_matched_gene",
+            "matched_gene_not_in_reference",
+            "projected",
+            "memoised",
+            "no_compatible_start_codon",
+            "with_3ui",
+            "comparisons",
+            "not_coding",
+            "cds_chain_mismatch",
+            "no_utr_introns",
+            "start_stop_in_intron",
+            "no_3utr_introns",
+            "partners")
+
+
+@contextlib.contextmanager
+def timeStage(timers, stage):
+    '''Add the wall clock time spent in the block to timers[stage]'''
+    start = time.time()
+    try:
+        yield
+    finally:
+        timers[stage] += time.time() - start
+
+
+def writeSummary(summary_file, counts, timers):
+    '''Write the counts (see COUNTERS) and stage timers of a run. If
+    summary_file ends in .json, they are written as JSON, otherwise as
+    a table with the columns section, name and value.'''
+
+    counts = OrderedDict((name, counts[name]) for name in COUNTERS)
+    timers = OrderedDict((stage, round(seconds, 3))
+                         for stage, seconds in timers.items())
+
+    with IOTools.open_file(summary_file, "w") as outf:
+        if summary_file.endswith(".json"):
+            json.dump(OrderedDict((("counts", counts), ("timers", timers))),
+                      outf, indent=2)
+            outf.write("\n")
+        else:
+            outf.write("section\tname\tvalue\n")
+            for name, value in counts.items():
+                outf.write("counts\t%s\t%i\n" % (name, value))
+            for stage, seconds in timers.items():
+                outf.write("timers\t%s\t%s\n" % (stage, seconds))
+
+
+def _noOutput():
+    return tuple([] for stream in OUTPUTS)
+
+
+def findPartners(exons, introns, ens_gene, splice_sites, options=None,
+                 output_novel=False, counts=None):
+    '''Compare the structure of a novel transcript, given as its exons and
+    introns, to the reference models of its matched gene. 3' UTR introns
+    are novel or not in a CDS by reference to splice_sites, a
+    :class:`SpliceSiteIndex` of the whole reference. Returns a tuple
+    with one entry for each model the transcript has extra 3' UTR introns
+    compared to:
+
+        (ref_transcript_id, ens_stop, utr3_introns, partnered_introns,
+         novel_introns, no_cds_introns)
+
+    The result holds nothing specific to the novel transcript other than
+    its structure, so it can be reused for any transcript with the same
+    exons in the same gene.
+
+    If counts is given, the reason each comparison is rejected is counted
+    there (see COUNTERS).'''
+
+    if counts is None:
+        counts = Counter()
+
+    partners = []
+    exon_starts = [e[0] for e in exons]
+    first_introns = set(introns)
+
+    # check if this ever gets the wrong start_codon. 
+    filtered_starts = [s for s in ens_gene["start_codons"] if
+                       _in_exon(s, exons, exon_starts)]
+
+    if len(filtered_starts) == 0:
+        if output_novel:
+            E.debug("No starts found for %s" % options.novel_id)
+        counts["no_compatible_start_codon"] += 1
+        return tuple(partners)
+    
+    selected_models = list()
+    for startc in filtered_starts:
+        selected_models.extend(ens_gene["start_codons"][startc])
+
+    if output_novel:
+        E.debug("Transcripts with compatible starts are %s" % selected_models)
+
+    # the novel CDS intron chain only depends on the CDS bounds of the
+    # model it is compared to, so it is computed once per distinct bounds
+    # and matched to models by lookup in the gene's chain index
+    chain_matches = dict()
+
+    for ref_transcript_id in selected_models:
+
+        if output_novel and ref_transcript_id == options.target_id:
+            output_ref=True
+        else:
+            output_ref=False
+            
+        second = ens_gene["models"][ref_transcript_id]
+        counts["comparisons"] += 1
         
-        for transcript in ens_gene:
+        if second.cds is None:
+            if output_ref:
+                E.debug("%s is not coding") # ensure only protein-coding transcripts
+            counts["not_coding"] += 1
+            continue
+
+        cds_start, cds_end = second.cds
+
+        if second.cds not in chain_matches:
+            first_CDSintrons = frozenset(intron for intron in first_introns if
+                                         (intron[0] > cds_start and
+                                          intron[1] < cds_end))
+            chain_matches[second.cds] = (
+                first_CDSintrons,
+                ens_gene["cds_chains"].get((second.cds, first_CDSintrons), ()))
+
+        first_CDSintrons, matched_models = chain_matches[second.cds]
+
+        if ref_transcript_id not in matched_models:
+            if output_ref:
+                E.debug("CDS chains do not match. Chains are:")
+                first_CDSintrons = sorted(list(first_CDSintrons))
+                second_CDSintrons = sorted(list(second.cds_introns))
+                output = "\n".join(map(str, zip(first_CDSintrons, second_CDSintrons)))
+                E.debug(output)
+            counts["cds_chain_mismatch"] += 1
+            continue                           # match CDS intron chain
 
-            transcript_id = transcript[0].transcript_id
-            table[geneid]["models"][transcript_id] = transcript
+                  
+        firstUTRintrons = first_introns - first_CDSintrons
+
+        if len(firstUTRintrons) == 0:
+            if output_ref:
+                E.debug("No UTR introns")
+            counts["no_utr_introns"] += 1
+            continue
+
+        found = False
+        for intron in first_introns:
+            if (intron[0] < cds_end and
+                intron[1] > cds_end) or \
+                (intron[0] < cds_start and
+                 intron[1] > cds_start):
+
+                found=True
+                break      # ensure pruned transcript doesn't have
+                    # introns overlapping start or stop codons in ensembl
+                    # transcript
+        if found:
+            if output_ref:
+                E.debug("Start or stop in intron")
+            counts["start_stop_in_intron"] += 1
+            continue
+        
+        if second.strand == "+":
+            ens_stop = cds_end
+            UTR3introns = [intron for intron in firstUTRintrons if
+                           intron[0] >= cds_end and
+                           intron[1] < second.exons[1]]
+        else:
+            ens_stop = cds_start
+            UTR3introns = [intron for intron in firstUTRintrons if
+                           intron[1] <= cds_start and
+                           intron[0] > second.exons[0]]
+
+        if len(UTR3introns) == 0:
+            if output_ref:
+                E.debug("No UTR introns")
+            counts["no_3utr_introns"] += 1
+            continue
+
+        UTR3introns.sort()
+
+        secondUTR3introns = second.utr3_introns
+        extraUTR3introns = sorted(set(UTR3introns) - secondUTR3introns)
+        missingUTR3introns = secondUTR3introns.difference(UTR3introns)
+        
+        if output_ref and len(missingUTR3introns) > 0:
+            E.debug("Following introns in UTR of %s but not %s" % (options.target_id, options.novel_id))
+            E.debug(missingUTR3introns)
             
-            CDS = GTF.asRanges(transcript, "start_codon")
-            if len(CDS) == 0:
+        # get only introns that are not in matched transcript
+        if len(extraUTR3introns) != 0 and len(missingUTR3introns) == 0:
+            partnered_introns = tuple(extraUTR3introns)
+        else:
+            partnered_introns = ()
+
+        contig, strand = second.contig, second.strand
+        novelEvents = tuple(i for i in UTR3introns if
+                            splice_sites.isNovel(contig, strand, i))
+
+        not_cds_events = tuple(i for i in UTR3introns if
+                               splice_sites.isNotCDS(contig, strand, i))
+
+        counts["partners"] += 1
+        partners.append((ref_transcript_id,
+                         ens_stop,
+                         tuple(UTR3introns),
+                         partnered_introns,
+                         novelEvents,
+                         not_cds_events))
+
+    return tuple(partners)
+
+
+def _bed6(novel_transcript, name, interval, ens_stop):
+    outbed = Bed.Bed()
+    outbed.fields = ['.', '.', '.', '.']
+    outbed.fromIntervals([interval])
+    outbed.contig = novel_transcript[0].contig
+    outbed["name"] = name
+    outbed["strand"] = novel_transcript[0].strand
+    outbed["thickStart"] = ens_stop
+    return str(outbed)
+
+
+def _bed12(novel_transcript, name, intervals):
+    outbed = Bed.Bed()
+    outbed.fields = ['.'] * 9
+    outbed.fromIntervals(intervals)
+    outbed.contig = novel_transcript[0].contig
+    outbed["name"] = name
+    outbed["strand"] = novel_transcript[0].strand
+    return str(outbed)
+
+
+def formatPartners(novel_transcript, partners, ens_gene, options):
+    '''Produce the output lines for novel_transcript from the partners
+    found by :func:`findPartners`, one list per stream in OUTPUTS.'''
+
+    outputs = _noOutput()
+    (outlines, individuals, partnered, individualpartnered, novel,
+     not_cds_utrons, novel_transcript_cds, table) = outputs
+
+    novel_transcript_id = novel_transcript[0].transcript_id
+
+    for (ref_transcript_id, ens_stop, UTR3introns, partnered_introns,
+         novel_events, not_cds_events) in partners:
+
+        paired_name = novel_transcript_id + ":" + ref_transcript_id
+
+        outlines.append(_bed12(novel_transcript, novel_transcript_id,
+                               UTR3introns))  # get output for each transcript
+        individuals.extend(_bed6(novel_transcript, novel_transcript_id,
+                                 item, ens_stop)
+                           for item in UTR3introns)  # get output for each intron
+
+        if partnered_introns:
+            partnered.append(_bed12(novel_transcript, paired_name,
+                                    partnered_introns))
+            individualpartnered.extend(_bed6(novel_transcript, paired_name,
+                                             item, ens_stop)
+                                       for item in partnered_introns)
+
+        novel.extend(_bed6(novel_transcript, paired_name, item, ens_stop)
+                     for item in novel_events)
+        not_cds_utrons.extend(_bed6(novel_transcript, paired_name, item,
+                                    ens_stop)
+                              for item in not_cds_events)
+
+        if options.table_out is not None:
+            partner = (ref_transcript_id, ens_stop, UTR3introns,
+                       partnered_introns, novel_events, not_cds_events)
+            for category, field in UTRON_CATEGORIES:
+                table.extend("\t".join(map(str, (
+                    novel_transcript_id, ens_gene["gene_id"],
+                    ref_transcript_id, ens_stop, category,
+                    novel_transcript[0].contig, start, end,
+                    novel_transcript[0].strand)))
+                    for start, end in partner[field])
+
+    if (options.gtf_out is not None) and (len(partners) > 0):
+
+        # copy the CDS from the transcript itself if it is one of the
+        # partners, otherwise from the first partner
+        partner_ids = [partner[0] for partner in partners]
+        if novel_transcript_id in partner_ids:
+            copied_from = novel_transcript_id
+        else:
+            copied_from = partner_ids[0]
+
+        second = ens_gene["models"][copied_from]
+        protein_id = second.protein_id
+            
+        attributes = novel_transcript[0].attribute_string2dict(novel_transcript[0].attributes)
+        attributes["copied_from"] =  copied_from
+        novel_gene_id = novel_transcript[0].gene_id
+        if protein_id:
+            attributes["protein_id"] = protein_id
+        del attributes["gene_id"]
+        del attributes["transcript_id"]
+
+        CDS = second.cdsEntries(novel_gene_id, novel_transcript_id,
+                                attributes)
+
+        novel_transcript = list(filter(lambda x: x.feature != "CDS", novel_transcript))
+        novel_transcript.extend(CDS)
+        novel_transcript = sorted(novel_transcript, key = lambda x: x.start)
+        novel_transcript_cds.extend(map(str, novel_transcript))
+
+    return outputs
+
+
+def matchPartners(novel_transcript, enshashtable, splice_sites, db,
+                  options=None, memo=None, counts=None):
+    '''Find the partners of a novel transcript among the reference models
+    of its matched gene (see :func:`findPartners`). Returns the matched
+    gene and the partners, or None and no partners if the transcript has
+    no matched gene in the reference.
+
+    If memo is given, the partners of each distinct structure are stored
+    there, keyed on matched gene and exons, and reused for later
+    transcripts with the same structure.
+
+    If counts is given, the outcome for the transcript is counted there
+    (see COUNTERS). Comparisons to reference models are only counted
+    when they are made, not when partners are taken from the memo.'''
+
+    if counts is None:
+        counts = Counter()
+    counts["transcripts"] += 1
+
+    # Why do it on a gene by gene basis rather than transcript by transcript basis?
+    transcript_id = novel_transcript[0].transcript_id
+
+    if options is not None and transcript_id == options.novel_id:
+        output_novel = True
+    else:
+        output_novel = False
+    
+    if transcript_id not in db:
+        if output_novel:
+            E.debug("Transcript %s not in class table" % transcript_id)
+        counts["not_in_class_table"] += 1
+        return None, ()
+
+    geneid = db[transcript_id]
+
+    if geneid is None:
+        if output_novel:
+            E.debug("Transcript %s matches no gene in class table" % transcript_id)
+        counts["no_matched_gene"] += 1
+        return None, ()
+
+    ens_gene = enshashtable.get(geneid, {})
+    
+    # matched gene is not in the filtered reference.    
+    if "models" not in ens_gene:
+        counts["matched_gene_not_in_reference"] += 1
+        return None, ()
+    
+    novel_transcript_exons, novel_transcript_introns = \
+        transcriptStructure(novel_transcript)
+
+    if memo is None or output_novel:
+        partners = findPartners(novel_transcript_exons,
+                                novel_transcript_introns,
+                                ens_gene, splice_sites, options,
+                                output_novel, counts)
+    else:
+        key = (geneid, tuple(novel_transcript_exons))
+        partners = memo.get(key)
+        if partners is None:
+            partners = findPartners(novel_transcript_exons,
+                                    novel_transcript_introns,
+                                    ens_gene, splice_sites, counts=counts)
+            memo[key] = partners
+        else:
+            counts["memoised"] += 1
+
+    if partners:
+        counts["with_3ui"] += 1
+
+    return ens_gene, partners
+
+
+def classifyTranscript(novel_transcript, enshashtable, splice_sites, db,
+                       options, memo=None, projection=None, counts=None):
+    '''Find the 3' UTR introns of a novel transcript by comparison to the
+    reference models of its matched gene. Returns one list of output lines
+    for each of the streams in OUTPUTS.
+
+    If projection, a transcript map and the partners returned by
+    :func:`loadProjection`, is given, transcripts in the map take the
+    partners of the transcript they map to rather than being compared to
+    the reference.'''
+
+    transcript_id = novel_transcript[0].transcript_id
+
+    if projection is not None and transcript_id in projection[0]:
+        if counts is not None:
+            counts["projected"] += 1
+        gene_id, partners = projection[1].get(projection[0][transcript_id],
+                                              (None, ()))
+        ens_gene = enshashtable.get(gene_id, {})
+        if not partners or "models" not in ens_gene:
+            return _noOutput()
+        if counts is not None:
+            counts["with_3ui"] += 1
+        return formatPartners(novel_transcript, partners, ens_gene, options)
+
+    ens_gene, partners = matchPartners(novel_transcript, enshashtable,
+                                       splice_sites, db, options, memo,
+                                       counts)
+
+    if ens_gene is None:
+        return _noOutput()
+
+    return formatPartners(novel_transcript, partners, ens_gene, options)
+
+
+def loadTranscriptMap(map_file):
+    '''Read the ref_id and query_id columns of a transcript map, such as
+    those written by trmap2tsv in pipeline_utrons_annotate, into a dict
+    from query to reference transcript.
+
+    Queries matched to more than one reference transcript are left out,
+    so that they are classified rather than given the 3UIs of whichever
+    match came last.'''
+
+    transcript_map = dict()
+    ambiguous = set()
+    with IOTools.open_file(map_file) as inf:
+        header = inf.readline().rstrip("\n").split("\t")
+        ref_col = header.index("ref_id")
+        query_col = header.index("query_id")
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            query_id, ref_id = fields[query_col], fields[ref_col]
+            if transcript_map.get(query_id, ref_id) != ref_id:
+                ambiguous.add(query_id)
+            transcript_map[query_id] = sys.intern(ref_id)
+
+    for query_id in ambiguous:
+        del transcript_map[query_id]
+
+    if ambiguous:
+        E.warn("%i transcripts match more than one reference transcript "
+               "and will be classified" % len(ambiguous))
+
+    E.info("Transcript map loaded: %i transcripts" % len(transcript_map))
+    return transcript_map
+
+
+def loadProjection(table_file):
+    '''Read the partners of each transcript back from a table written by
+    the table stream (see TABLE_COLUMNS). Returns a dict from transcript
+    id to its matched gene and a tuple of partners, as returned by
+    :func:`findPartners`.'''
+
+    fields_of = dict((category, field)
+                     for category, field in UTRON_CATEGORIES)
+    partners = defaultdict(OrderedDict)
+    genes = dict()
+
+    with IOTools.open_file(table_file) as inf:
+        header = inf.readline().rstrip("\n").split("\t")
+        for line in inf:
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            transcript_id = sys.intern(row["transcript_id"])
+            genes[transcript_id] = sys.intern(row["match_gene_id"])
+            transcript_partners = partners[transcript_id]
+            if row["match_transcript_id"] not in transcript_partners:
+                transcript_partners[row["match_transcript_id"]] = \
+                    [row["match_transcript_id"], int(row["ens_stop"]),
+                     [], [], [], []]
+            partner = transcript_partners[row["match_transcript_id"]]
+            partner[fields_of[row["category"]]].append(
+                (int(row["start"]), int(row["end"])))
+
+    projection = dict(
+        (transcript_id,
+         (genes[transcript_id],
+          tuple(tuple(partner[:2]) + tuple(tuple(introns)
+                                           for introns in partner[2:])
+                for partner in transcript_partners.values())))
+        for transcript_id, transcript_partners in partners.items())
+
+    E.info("Projection loaded: %i transcripts with 3UIs" % len(projection))
+    return projection
+
+
+def find_utrons(reference, classes, transcripts, memo=None,
+                as_arrow=False, counts=None):
+    '''Find the 3' UTR introns of transcripts without writing any files.
+
+    reference is the gene table and splice site index returned by
+    :func:`getGeneTable`, classes maps transcript ids to their matched
+    gene, as returned by :func:`loadClassTable`, and transcripts is an
+    iterable of transcripts, each a list of GTF entries, such as
+    ``GTF.transcript_iterator(GTF.iterator(infile))``.
+
+    Returns a dict with a table for each category in UTRON_CATEGORIES,
+    with one row per 3UI and reference transcript it was found against,
+    in the columns of UTRON_COLUMNS. ens_stop is the stop codon of the
+    reference transcript. Coordinates are 0-based, half-open. Tables are
+    pandas DataFrames, or pyarrow Tables if as_arrow is set.
+
+    This reports the same introns as the BED files of find_utrons.py,
+    where the name of each is "transcript_id" in the all and individual
+    files and "transcript_id:match_transcript_id" in the others.
+
+    If counts is given, the outcome for each transcript and comparison
+    is counted there (see COUNTERS).'''
+
+    enshashtable, splice_sites = reference
+    columns = dict((category, dict((column, []) for column in UTRON_COLUMNS))
+                   for category, field in UTRON_CATEGORIES)
+
+    for novel_transcript in transcripts:
+        ens_gene, partners = matchPartners(novel_transcript, enshashtable,
+                                           splice_sites, classes, memo=memo,
+                                           counts=counts)
+        if not partners:
+            continue
+
+        contig = novel_transcript[0].contig
+        strand = novel_transcript[0].strand
+        transcript_id = novel_transcript[0].transcript_id
+
+        for partner in partners:
+            for category, field in UTRON_CATEGORIES:
+                table = columns[category]
+                for start, end in partner[field]:
+                    table["contig"].append(contig)
+                    table["start"].append(start)
+                    table["end"].append(end)
+                    table["strand"].append(strand)
+                    table["transcript_id"].append(transcript_id)
+                    table["match_transcript_id"].append(partner[0])
+                    table["ens_stop"].append(partner[1])
+
+    if as_arrow:
+        import pyarrow as pa
+        schema = pa.schema([("contig", pa.string()),
+                            ("start", pa.int64()),
+                            ("end", pa.int64()),
+                            ("strand", pa.string()),
+                            ("transcript_id", pa.string()),
+                            ("match_transcript_id", pa.string()),
+                            ("ens_stop", pa.int64())])
+        return dict((category, pa.table(table, schema=schema))
+                    for category, table in columns.items())
+    else:
+        import pandas
+        return dict((category, pandas.DataFrame(table,
+                                                columns=UTRON_COLUMNS))
+                    for category, table in columns.items())
+
+
+# bump when the layout or meaning of memoised partners changes. 3: memos
+# written from a cached reference had no CDS introns, so called every 3UI
+# no-CDS
+MEMO_VERSION = 3
+
+
+def loadMemo(memo_file, reference_digest):
+    '''Load partners memoised by an earlier run against the same
+    reference. Returns an empty memo if there is none.'''
+
+    if not os.path.exists(memo_file):
+        return dict()
+
+    with open(memo_file, "rb") as inf:
+        stored = pickle.load(inf)
+
+    if stored["version"] != MEMO_VERSION or \
+       stored["reference"] != reference_digest:
+        E.warn("Ignoring %s: made with a different reference or version" %
+               memo_file)
+        return dict()
+
+    return stored["partners"]
+
+
+def saveMemo(memo, memo_file, reference_digest):
+    '''Save memoised partners, adding to those already in memo_file.
+
+    Many jobs share a memo file, so it is read, merged and written while
+    holding a lock on memo_file.lock, and no job loses the partners that
+    another saved since it loaded the memo. The memo is replaced rather
+    than written in place, so it can be loaded without the lock.'''
+
+    import fcntl
+
+    # lockf rather than flock, as it also locks on NFS
+    with open(memo_file + ".lock", "a") as lock:
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            stored = loadMemo(memo_file, reference_digest)
+            stored.update(memo)
+
+            tmp_file = "%s.%i.tmp" % (memo_file, os.getpid())
+            with open(tmp_file, "wb") as outf:
+                pickle.dump({"version": MEMO_VERSION,
+                             "reference": reference_digest,
+                             "partners": stored},
+                            outf, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, memo_file)
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+# state shared with worker processes. With the fork start method this is
+# inherited from the parent, so the reference is not copied per task.
+_worker_state = {}
+
+
+def _initWorker(enshashtable, splice_sites, db, options, memo,
+                projection=None):
+    _worker_state["enshashtable"] = enshashtable
+    _worker_state["splice_sites"] = splice_sites
+    _worker_state["db"] = db
+    _worker_state["options"] = options
+    _worker_state["memo"] = memo
+    _worker_state["projection"] = projection
+
+
+def _classifyBlock(lines):
+    '''Classify the transcripts in a block of GTF lines, returning the
+    output of all of them concatenated per stream, any partners newly
+    added to the memo, the counts for the block and the time taken.'''
+
+    start = time.time()
+    results = _noOutput()
+    counts = Counter()
+
+    if _worker_state["memo"] is not None:
+        new_partners = dict()
+        memo = ChainMap(new_partners, _worker_state["memo"])
+    else:
+        new_partners = None
+        memo = None
+
+    gtf = GTF.iterator(io.StringIO("".join(lines)))
+    for novel_transcript in GTF.transcript_iterator(gtf):
+        outputs = classifyTranscript(novel_transcript,
+                                     _worker_state["enshashtable"],
+                                     _worker_state["splice_sites"],
+                                     _worker_state["db"],
+                                     _worker_state["options"],
+                                     memo,
+                                     _worker_state["projection"],
+                                     counts)
+        for result, output in zip(results, outputs):
+            result.extend(output)
+
+    return results, new_partners, counts, time.time() - start
+
+
+def _transcriptId(line):
+    '''Get the transcript_id from the text of a GTF line without parsing
+    it'''
+    return gtfAttribute(line, "transcript_id")
+
+
+def _sortKey(line):
+    '''The order of cgat gtf2gtf --method=sort --sort-order=gene+transcript'''
+    fields = line.split("\t", 4)
+    return (_geneId(line) or "", _transcriptId(line) or "", fields[0],
+            int(fields[3]))
+
+
+def _bedKey(line):
+    '''The order of sort -k1,1 -k2,2n -k3,3n, as tabix requires'''
+    fields = line.split("\t", 3)
+    return (fields[0], int(fields[1]), int(fields[2]))
+
+
+def _readChunk(chunk_file, key=_sortKey):
+    with open(chunk_file) as inf:
+        for line in inf:
+            index, line = line.split("\t", 1)
+            yield (key(line), int(index)), line
+
+
+def iterateSortedLines(infile, buffer_size=1000000, key=_sortKey):
+    '''Iterate over the lines of a GTF in gene, transcript, contig and
+    start order, as cgat gtf2gtf --sort-order=gene+transcript would
+    output them, or in the order given by key, a function of a line.
+    Ties keep their input order.
+
+    At most buffer_size lines are held in memory. Larger inputs are
+    sorted in chunks of that size, which are written to temporary files
+    and merged.'''
+
+    def _chunks():
+        chunk = []
+        for index, line in enumerate(infile):
+            if line.startswith("#"):
                 continue
+            if not line.endswith("\n"):
+                line += "\n"
+            chunk.append(((key(line), index), line))
+            if len(chunk) >= buffer_size:
+                chunk.sort()
+                yield chunk
+                chunk = []
+        chunk.sort()
+        yield chunk
 
-            if transcript[0].strand == "-":
-                start_codon = max(e[1] for e in CDS)
-            else:
-                start_codon = min(e[0] for e in CDS)
+    chunks = _chunks()
+    first = next(chunks)
+    second = next(chunks, None)
 
-            table[geneid]["start_codons"][start_codon].append(transcript_id)
+    if second is None:
+        for line_key, line in first:
+            yield line
+        return
 
-    E.info("Reference Loaded")
-    return table
+    with tempfile.TemporaryDirectory() as tmpdir:
+        chunk_files = []
+
+        def _spill(chunk):
+            chunk_file = os.path.join(tmpdir, "%i.gtf" % len(chunk_files))
+            with open(chunk_file, "w") as outf:
+                for (line_key, index), line in chunk:
+                    outf.write("%i\t%s" % (index, line))
+            chunk_files.append(chunk_file)
+
+        _spill(first)
+        _spill(second)
+        first = second = None
+        for chunk in chunks:
+            _spill(chunk)
+
+        E.info("Merging %i sorted chunks of input" % len(chunk_files))
+        for line_key, line in heapq.merge(
+                *(_readChunk(chunk_file, key) for chunk_file in chunk_files)):
+            yield line
+
+
+def iterateGeneBlocks(infile, block_size=10000):
+    '''Split a GTF sorted by gene and transcript into blocks of at least
+    block_size lines, breaking only between genes.'''
+
+    block = []
+    last_gene = None
+    for line in infile:
+        if line.startswith("#"):
+            continue
+        gene_id = _geneId(line)
+        if gene_id != last_gene and len(block) >= block_size:
+            yield block
+            block = []
+        last_gene = gene_id
+        block.append(line)
+
+    if block:
+        yield block
+
+
+def _mergeBlocks(block_results, memo, counts, timers):
+    '''Add the partners, counts and time of each block to memo, counts
+    and timers as blocks are returned by _classifyBlock, yielding the
+    outputs of each.'''
+    for outputs, new_partners, block_counts, seconds in block_results:
+        memo.update(new_partners)
+        counts.update(block_counts)
+        # summed over blocks, so with several processes this can be more
+        # than the wall clock time of the classify stage
+        timers["classify_blocks"] += seconds
+        yield outputs
+
+
+def writeIndexedBed(infile, filename, index_format="tbi",
+                    buffer_size=1000000):
+    '''Write the lines of a BED file to filename sorted by position and
+    BGZF compressed, and index it with tabix. index_format is "tbi", or
+    "csi" for contigs longer than 2^29 bases. At most buffer_size lines
+    are held in memory while sorting.'''
+
+    import pysam
+
+    tmp_file = "%s.%i.tmp" % (filename, os.getpid())
+    with open(tmp_file, "w") as outf:
+        outf.writelines(iterateSortedLines(infile, buffer_size, _bedKey))
+
+    pysam.tabix_compress(tmp_file, filename, force=True)
+    os.unlink(tmp_file)
+    pysam.tabix_index(filename, preset="bed", force=True,
+                      csi=index_format == "csi")
+
+
+def writeOutputs(results, filenames, index_format=None,
+                 buffer_size=1000000):
+    '''Write the outputs of each block in results to the file for its
+    stream in filenames, which are in the order of OUTPUTS. Output is
+    written as each block is classified. Streams without a file name are
+    dropped.
+
+    If index_format is given, BED streams are written to a temporary file
+    and then sorted, compressed and indexed (see
+    :func:`writeIndexedBed`).'''
+
+    if index_format is not None:
+        indexed = [stream in BED_OUTPUTS and bool(filename)
+                   for stream, filename in zip(OUTPUTS, filenames)]
+    else:
+        indexed = [False] * len(OUTPUTS)
+
+    outfiles = [open("%s.%i.unsorted" % (filename, os.getpid()), "w")
+                if index else
+                IOTools.open_file(filename, "w") if filename else None
+                for filename, index in zip(filenames, indexed)]
+
+    table = outfiles[OUTPUTS.index("table")]
+    if table is not None:
+        table.write("\t".join(TABLE_COLUMNS) + "\n")
+
+    for outputs in results:
+        for outf, output in zip(outfiles, outputs):
+            if outf is not None and output:
+                outf.write("\n".join(output) + "\n")
+
+    for outf in outfiles:
+        if outf is not None:
+            outf.close()
+
+    for outf, filename, index in zip(outfiles, filenames, indexed):
+        if index:
+            with open(outf.name) as inf:
+                writeIndexedBed(inf, filename, index_format, buffer_size)
+            os.unlink(outf.name)
+
+
+# the suffix added to the output_prefix of an assembly in a --batch-file
+# to name the file for each stream in OUTPUTS
+BATCH_SUFFIXES = (".all_utrons.bed.gz",
+                  ".indevidual_utrons.bed.gz",
+                  ".partnered_utrons.bed.gz",
+                  ".individual_partnered_utrons.bed.gz",
+                  ".novel_utrons.bed.gz",
+                  ".no_cds_utrons.bed.gz",
+                  ".gtf.gz",
+                  ".utrons.tsv.gz")
+
+
+def readBatchFile(batch_file):
+    '''Read the assemblies listed in a --batch-file, a tab separated
+    table with a header. The columns infile, class_file and output_prefix
+    are required. The file for each stream in OUTPUTS is named from the
+    output_prefix (see BATCH_SUFFIXES), unless the table has a column
+    named after the stream, in which case it gives the file name. An
+    empty file name drops the stream. An optional transcript_map column
+    gives the map used to project partners with --project-table.
+
+    Returns a list of (infile, class_file, filenames, transcript_map)
+    tuples, with the file names in the order of OUTPUTS.'''
+
+    assemblies = []
+    with IOTools.open_file(batch_file) as inf:
+        header = inf.readline().rstrip("\n").split("\t")
+        for line in inf:
+            if line.startswith("#") or not line.strip():
+                continue
+            row = dict(zip(header, line.rstrip("\n").split("\t")))
+            filenames = tuple(row.get(stream,
+                                      row["output_prefix"] + suffix)
+                              for stream, suffix in zip(OUTPUTS,
+                                                        BATCH_SUFFIXES))
+            assemblies.append((row["infile"], row["class_file"], filenames,
+                               row.get("transcript_map") or None))
+
+    return assemblies
+
+
+def _classifyAssembly(assembly):
+    '''Classify the transcripts of one assembly of a batch, writing its
+    outputs. Returns any partners newly added to the memo, and the counts
+    and timers for the assembly.'''
+
+    infile, classfile, filenames, transcript_map = assembly
+    E.info("Classifying %s" % infile)
+
+    options = copy.copy(_worker_state["options"])
+    options.gtf_out = filenames[OUTPUTS.index("gtf")] or None
+    options.table_out = filenames[OUTPUTS.index("table")] or None
+    _worker_state["options"] = options
+    counts, timers = Counter(), Counter()
+
+    with timeStage(timers, "class_table"):
+        _worker_state["db"] = loadClassTable(classfile)
+
+    if transcript_map is not None and _worker_state["partners"] is not None:
+        _worker_state["projection"] = (loadTranscriptMap(transcript_map),
+                                       _worker_state["partners"])
+    else:
+        _worker_state["projection"] = None
+
+    # partners found here are added to this worker's memo, for later
+    # blocks and assemblies, and returned to be saved
+    new_partners = dict()
+
+    def _collectMemo(block_results):
+        for block_result in block_results:
+            new_partners.update(block_result[1])
+            yield block_result
+
+    lines = iterateSortedLines(IOTools.open_file(infile),
+                               options.sort_buffer_size)
+    block_results = _collectMemo(map(_classifyBlock, iterateGeneBlocks(lines)))
+    with timeStage(timers, "classify"):
+        writeOutputs(_mergeBlocks(block_results, _worker_state["memo"],
+                                  counts, timers),
+                     filenames, options.index_output,
+                     options.sort_buffer_size)
+
+    E.info("Finished %s" % infile)
+    return new_partners, counts, timers
+
+
+def runBatch(assemblies, enshashtable, splice_sites, options, memo,
+             counts, timers, partners=None):
+    '''Classify each of a batch of assemblies against a single copy of
+    the reference, running options.processes assemblies at a time. If
+    partners, as returned by :func:`loadProjection`, are given, they are
+    projected onto the assemblies with a transcript_map. The counts and
+    timers of all assemblies are added to counts and timers.'''
+
+    E.info("Classifying %i assemblies" % len(assemblies))
+    _worker_state["partners"] = partners
+
+    if options.processes > 1:
+        pool = multiprocessing.get_context("fork").Pool(
+            options.processes,
+            initializer=_initWorker,
+            initargs=(enshashtable, splice_sites, None, options, memo))
+        results = pool.imap_unordered(_classifyAssembly, assemblies)
+    else:
+        _initWorker(enshashtable, splice_sites, None, options, memo)
+        results = map(_classifyAssembly, assemblies)
+
+    for new_partners, assembly_counts, assembly_timers in results:
+        memo.update(new_partners)
+        counts.update(assembly_counts)
+        timers.update(assembly_timers)
+
+    if options.processes > 1:
+        pool.close()
+        pool.join()
 
 
 def main(argv=None):
@@ -105,6 +1561,62 @@ def main(argv=None):
                       help="Outfile for introns that overlap CDS in no transcripts")
     parser.add_option("-g", "--gtf-out-file", dest="gtf_out", type="string",
                       help="Supply a file name to output 3UI transcripts with annotated CDS")
+    parser.add_option("--table-out", dest="table_out", type="string",
+                      help="Supply a file name to output a table of all 3UIs "
+                           "and the reference transcript each was found "
+                           "against, for use with --project-table")
+    parser.add_option("--project-table", dest="project_table", type="string",
+                      help="Table written by --table-out for another assembly, "
+                           "such as the merge of all assemblies. Transcripts "
+                           "with a match in --transcript-map take the 3UIs of "
+                           "the transcript they match in this table, rather "
+                           "than being classified")
+    parser.add_option("--transcript-map", dest="transcript_map", type="string",
+                      help="Table with the columns ref_id and query_id mapping "
+                           "input transcripts to transcripts in --project-table, "
+                           "such as the = matches of trmap")
+    parser.add_option("--reference-cache", dest="reference_cache", type="string",
+                      help="Directory in which to keep a compiled copy of the "
+                           "reference. It is built on first use and reused by "
+                           "later runs against the same reference")
+    parser.add_option("--lazy-reference", dest="lazy_reference",
+                      action="store_true", default=False,
+                      help="Only load reference genes that are the match_gene_id "
+                           "of a transcript in the class file")
+    parser.add_option("--processes", dest="processes", type="int", default=1,
+                      help="Classify blocks of genes from the input in this "
+                           "many processes. With --batch-file, the number of "
+                           "assemblies to classify at once")
+    parser.add_option("--batch-file", dest="batch_file", type="string",
+                      help="Table of assemblies to classify against the same "
+                           "reference, with the columns infile, class_file and "
+                           "output_prefix. The reference is loaded once for all "
+                           "of them and the input and output file options "
+                           "are ignored")
+    parser.add_option("--memo-file", dest="memo_file", type="string",
+                      help="File in which to keep the classification of each "
+                           "distinct transcript structure between runs against "
+                           "the same reference. The file grows with every run "
+                           "and is read in full by each")
+    parser.add_option("--input-sorted", dest="input_sorted",
+                      action="store_true", default=False,
+                      help="The input is already sorted by gene and transcript, "
+                           "so is not sorted again")
+    parser.add_option("--sort-buffer-size", dest="sort_buffer_size",
+                      type="int", default=1000000,
+                      help="Number of input lines to sort in memory. Larger "
+                           "inputs are sorted in chunks in temporary files")
+    parser.add_option("--summary-file", dest="summary_file", type="string",
+                      help="Write the number of transcripts and comparisons "
+                           "rejected for each reason, and the time spent in "
+                           "each stage, to this file. JSON if the name ends "
+                           "in .json, otherwise tab separated")
+    parser.add_option("--index-output", dest="index_output", type="choice",
+                      choices=("tbi", "csi"),
+                      help="Write the BED outputs sorted by position, BGZF "
+                           "compressed and indexed with tabix, with a .tbi "
+                           "index or, for contigs longer than 512Mb, a .csi "
+                           "index")
     parser.add_option("--novel-transcript", dest="novel_id", type="string",
                       help="DEBUG: Output info for this transcript from the STDIN")
     parser.add_option("--target-transcript", dest="target_id", type="string",
@@ -113,330 +1625,120 @@ def main(argv=None):
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv)
 
-    outlines = []
-    individuals = []
-    partnered = []
-    individualpartnered = []
-    novel = []
-    not_cds_utrons = []
-    novel_transcript_cds = []
-    
-    db = pandas.read_csv(options.classfile, sep="\t")
+    counts, timers = Counter(), Counter()
+    start = time.time()
 
-    # This keeps just one entry per-transcript - why? 
-    #db = db.groupby("transcript_id").first()
-    db = db.set_index("transcript_id")
-    enshashtable = getGeneTable(options.reffile)
-    
-    for novel_transcript in GTF.transcript_iterator(GTF.iterator(options.stdin)):
+    with timeStage(timers, "class_table"):
+        if options.batch_file is not None:
+            assemblies = readBatchFile(options.batch_file)
+            db = None
+        else:
+            db = loadClassTable(options.classfile)
 
-        # Why do it on a gene by gene basis rather than transcript by transcript basis?
-        transcript_id = novel_transcript[0].transcript_id
+    with timeStage(timers, "projection"):
+        if options.project_table is not None:
+            partners = loadProjection(options.project_table)
+        else:
+            partners = None
 
-        if transcript_id == options.novel_id:
-            output_novel = True
+    with timeStage(timers, "class_table"):
+        if options.lazy_reference:
+            if db is not None:
+                tables = [db]
+            else:
+                tables = (loadClassTable(assembly[1])
+                          for assembly in assemblies)
+            gene_ids = set(geneid for table in tables
+                           for geneid in table.values()
+                           if geneid is not None)
+            if partners is not None:
+                gene_ids.update(gene_id for gene_id, transcript_partners
+                                in partners.values())
         else:
-            output_novel = False
-        
-        try:
-            geneid = db.loc[transcript_id].match_gene_id
-        except KeyError:
-            if output_novel:
-                E.debug("Transcript %s not in class table" % transcript_id)
-            continue
+            gene_ids = None
 
-        if pandas.isnull(geneid):
-            if output_novel:
-                E.debug("Transcript %s matches no gene in class table" % transcript_id)
-            continue
+    with timeStage(timers, "reference"):
+        enshashtable, splice_sites = getGeneTable(options.reffile,
+                                                  options.reference_cache,
+                                                  gene_ids)
+    
+    # the same structure turns up under many transcript ids, so the
+    # partners found for each one are reused
+    with timeStage(timers, "memo_load"):
+        if options.memo_file is not None:
+            memo = loadMemo(options.memo_file,
+                            referenceDigest(options.reffile))
+            E.info("Loaded %i memoised structures" % len(memo))
+        else:
+            memo = dict()
 
-        ens_gene = enshashtable[geneid]
-        
-        # matched gene is not in the filtered reference.    
-        if "models" not in ens_gene:
-            continue
-        
-        all_ref_introns = set()
-        all_ref_cds_introns = set()
-        novel_transcript_exons = GTF.asRanges(novel_transcript, "exon")
-        novel_transcript_introns = GTF.toIntronIntervals(novel_transcript)      
-        for ref_transcript in ens_gene["models"].values():
-            ref_introns = GTF.toIntronIntervals(ref_transcript)
-            all_ref_introns.update(ref_introns)
-
-            ref_cds = GTF.asRanges(ref_transcript, "CDS")
-            if len(ref_cds) == 0:
-                continue
+    if options.batch_file is not None:
+        with timeStage(timers, "batch"):
+            runBatch(assemblies, enshashtable, splice_sites, options, memo,
+                     counts, timers, partners)
+    else:
+        with timeStage(timers, "projection"):
+            if partners is not None and options.transcript_map is not None:
+                projection = (loadTranscriptMap(options.transcript_map),
+                              partners)
+            else:
+                projection = None
 
-            ref_cds_introns = [intron for intron in ref_introns if
-                               (intron[0] > ref_cds[0][0] and
-                                intron[1] < ref_cds[-1][1])]
-            all_ref_cds_introns.update(ref_cds_introns)
+        # the input need not be sorted: transcripts are grouped here
+        if options.input_sorted:
+            lines = options.stdin
+        else:
+            lines = iterateSortedLines(options.stdin,
+                                       options.sort_buffer_size)
+        blocks = iterateGeneBlocks(lines)
 
-        #Identify comparison set
-        def _in_exon(position, exons):
-            return any(e[0] <= position <= e[1] for e in exons)
+        if options.processes > 1:
+            E.info("Classifying with %i processes" % options.processes)
+            pool = multiprocessing.get_context("fork").Pool(
+                options.processes,
+                initializer=_initWorker,
+                initargs=(enshashtable, splice_sites, db, options, memo,
+                          projection))
 
-        # check if this ever gets the wrong start_codon. 
-        filtered_starts = [s for s in ens_gene["start_codons"] if
-                           _in_exon(s, novel_transcript_exons)]
+            # imap returns blocks in input order, so the output is the same
+            # as a serial run
+            block_results = pool.imap(_classifyBlock, blocks)
+        else:
+            _initWorker(enshashtable, splice_sites, db, options, memo,
+                        projection)
+            block_results = map(_classifyBlock, blocks)
 
-        if len(filtered_starts) == 0:
-            if output_novel:
-                E.debug("No starts found for %s" % transcript_id)
-            continue
-        
-        selected_models = list()
-        for startc in filtered_starts:
-            selected_models.extend(ens_gene["start_codons"][startc])
+        # input is read, sorted and classified as output is written
+        with timeStage(timers, "classify"):
+            writeOutputs(_mergeBlocks(block_results, memo, counts, timers),
+                         (options.outfile,
+                          options.indivfile,
+                          options.partfile,
+                          options.indivpartfile,
+                          options.novelfile,
+                          options.not_cds_file,
+                          options.gtf_out,
+                          options.table_out),
+                         options.index_output,
+                         options.sort_buffer_size)
 
-        if output_novel:
-            E.debug("Transcripts with compatible starts are %s" % selected_models)
-            
-        CDS_dict = dict()
-        for ref_transcript_id in selected_models:
+        if options.processes > 1:
+            pool.close()
+            pool.join()
 
-            if output_novel and ref_transcript_id == options.target_id:
-                output_ref=True
-            else:
-                output_ref=False
-                
-            second = ens_gene["models"][ref_transcript_id]
-            ens_CDS = GTF.asRanges(second, "CDS")
-            
-            if len(ens_CDS) == 0:
-                if output_ref:
-                    E.debug("%s is not coding") # ensure only protein-coding transcripts
-                continue
+    with timeStage(timers, "memo_save"):
+        if options.memo_file is not None:
+            E.info("Saving %i memoised structures" % len(memo))
+            saveMemo(memo, options.memo_file,
+                     referenceDigest(options.reffile))
 
-            ens_exons = GTF.asRanges(second, "exon")
-            
-            first_introns = set(novel_transcript_introns)
-            second_introns = set(GTF.toIntronIntervals(second))
-
-            first_CDSintrons = [intron for intron in first_introns if
-                                (intron[0] > ens_CDS[0][0] and
-                                 intron[1] < ens_CDS[-1][1])]
-
-            second_CDSintrons = [intron for intron in second_introns if
-                                 (intron[0] > ens_CDS[0][0] and
-                                  intron[1] < ens_CDS[-1][1])]
-
-            first_CDSintrons = set(first_CDSintrons)
-            second_CDSintrons = set(second_CDSintrons)
-
-            if not first_CDSintrons == second_CDSintrons:
-                if output_ref:
-                    E.debug("CDS chains do not match. Chains are:")
-                    first_CDSintrons = sorted(list(first_CDSintrons))
-                    second_CDSintrons = sorted(list(second_CDSintrons))
-                    output = "\n".join(map(str, zip(first_CDSintrons, second_CDSintrons)))
-                    E.debug(output)
-                continue                           # match CDS intron chain
-
-                      
-            firstUTRintrons = first_introns - first_CDSintrons
-
-            if len(firstUTRintrons) == 0:
-                if output_ref:
-                    E.debug("No UTR introns")
-                continue
+    timers["total"] = time.time() - start
+    E.info("Classified %i transcripts: %i with 3UIs" %
+           (counts["transcripts"] + counts["projected"], counts["with_3ui"]))
 
-            secondUTRintrons = second_introns - second_CDSintrons
-
-            found = False
-            for intron in first_introns:
-                if (intron[0] < ens_CDS[-1][1] and
-                    intron[1] > ens_CDS[-1][1]) or \
-                    (intron[0] < ens_CDS[0][0] and
-                     intron[1] > ens_CDS[0][0]):
-
-                    found=True
-                    break      # ensure pruned transcript doesn't have
-                        # introns overlapping start or stop codons in ensembl
-                        # transcript
-            if found:
-                if output_ref:
-                    E.debug("Start or stop in intron")
-                continue
-            
-            if second[0].strand == "+":
-                ens_stop = ens_CDS[-1][1]
-                UTR3introns = [intron for intron in firstUTRintrons if
-                               intron[0] >= ens_CDS[-1][1] and
-                               intron[1] < ens_exons[-1][1]]
-                secondUTR3introns = [intron for intron in secondUTRintrons if
-                                     intron[0] >= ens_CDS[-1][1] and
-                                     intron[1] < ens_exons[-1][1]]
-            else:
-                ens_stop = ens_CDS[0][0]
-                UTR3introns = [intron for intron in firstUTRintrons if
-                               intron[1] <= ens_CDS[0][0] and
-                               intron[0] > ens_exons[0][0]]
-                secondUTR3introns =  [intron for intron in secondUTRintrons if
-                                      intron[1] <= ens_CDS[0][0] and
-                                      intron[0] > ens_exons[0][0]]
-
-            if len(UTR3introns) == 0:
-                if output_ref:
-                    E.debug("No UTR introns")
-                continue
-            
-            CDS_dict[ref_transcript_id] = []
-            
-            CDS = list(filter(lambda x: x.feature == "CDS", second))
-            copied_from = ref_transcript_id
-            
-            if "protein_id" in CDS[0].attributes:
-                protein_id = CDS[0].protein_id
-            else:
-                protein_id = None
-                
-            attributes = novel_transcript[0].attribute_string2dict(novel_transcript[0].attributes)
-            attributes["copied_from"] =  copied_from
-            novel_gene_id = novel_transcript[0].gene_id
-            novel_transcript_id = novel_transcript[0].transcript_id
-            if protein_id:
-                attributes["protein_id"] = protein_id
-            del attributes["gene_id"]
-            del attributes["transcript_id"]
-           
-            for exon in CDS:
-                exon = GTF.Entry().copy(exon)
-                exon.gene_id = novel_gene_id
-                exon.transcript_id = novel_transcript_id
-                exon.attributes = attributes
-                CDS_dict[ref_transcript_id].append(exon)
-               
-                
-            outbed = Bed.Bed()
-            outbed.fields = ['.', '.', '.', '.', '.', '.', '.', '.', '.']
-            outbed.fromIntervals(UTR3introns)
-            outbed.contig = novel_transcript[0].contig
-            outbed["name"] = novel_transcript[0].transcript_id
-            outbed["strand"] = novel_transcript[0].strand
-            outlines.append(outbed)        # get output for each transcript
-                    
-            for item in UTR3introns:
-                outbed2 = Bed.Bed()
-                outbed2.fields = ['.', '.', '.', '.']
-                outbed2.fromIntervals([item])
-                outbed2.contig = novel_transcript[0].contig
-                outbed2['name'] = novel_transcript[0].transcript_id
-                outbed2["strand"] = novel_transcript[0].strand
-                outbed2["thickStart"] = ens_stop
-                individuals.append(outbed2)  # get output for each intron
-          
-            UTR3introns = set(UTR3introns)
-            secondUTR3introns = set(secondUTR3introns)
-            extraUTR3introns = list(UTR3introns - secondUTR3introns)
+    if options.summary_file is not None:
+        writeSummary(options.summary_file, counts, timers)
 
-            
-            if output_ref and len(secondUTR3introns -  UTR3introns) > 0:
-                E.debug("Following introns in UTR of %s but not %s" % (options.target_id, options.novel_id))
-                E.debug(secondUTRintrons - UTR3introns)
-                
-            # get only introns that are not in matched transcript
-            if len(extraUTR3introns) != 0 and len(secondUTR3introns - UTR3introns) == 0:
-                outbed3 = Bed.Bed()
-                outbed3.fields = ['.'] * 9
-                outbed3.fromIntervals(extraUTR3introns)
-                outbed3.contig = novel_transcript[0].contig
-                outbed3["name"] = novel_transcript[0].transcript_id + ":" + second[0].transcript_id
-                outbed3["strand"] = novel_transcript[0].strand
-                partnered.append(outbed3)
-                        
-                for item in extraUTR3introns:
-                    outbed4 = Bed.Bed()
-                    outbed4.fields = ['.', '.', '.', '.']
-                    outbed4.fromIntervals([item])
-                    outbed4.contig = novel_transcript[0].contig
-                    outbed4["name"] = novel_transcript[0].transcript_id + ":" + second[0].transcript_id
-                    outbed4["strand"] = novel_transcript[0].strand
-                    outbed4["thickStart"] = ens_stop
-                    individualpartnered.append(outbed4)
-                
-            if len(all_ref_introns) == 0:
-                ens_starts, ens_ends = [], []
-            else:
-                ens_starts, ens_ends = zip(*all_ref_introns)
-
-            novelEvents = [i for i in UTR3introns if
-                           i[0] not in ens_starts and
-                           i[1] not in ens_ends]
-                
-            for item in novelEvents:
-                outbed5 = Bed.Bed()
-                outbed5.fields = ['.']*4
-                outbed5.fromIntervals([item])
-                outbed5.contig = novel_transcript[0].contig
-                outbed5["name"] = novel_transcript[0].transcript_id + ":" + second[0].transcript_id
-                outbed5["strand"] = novel_transcript[0].strand
-                outbed5["thickStart"] = ens_stop
-                novel.append(outbed5)
-
-            if len(all_ref_cds_introns) == 0:
-                cds_starts, cds_ends = [], []
-            else:
-                cds_starts, cds_ends = zip(*all_ref_cds_introns)
-
-            not_cds_events = [i for i in UTR3introns if
-                              i[0] not in cds_starts and
-                              i[1] not in cds_ends]
-                
-            for item in not_cds_events  :
-                outbed6 = Bed.Bed()
-                outbed6.fields = ['.']*4
-                outbed6.fromIntervals([item])
-                outbed6.contig = novel_transcript[0].contig
-                outbed6["name"] = novel_transcript[0].transcript_id + ":" + second[0].transcript_id
-                outbed6["strand"] = novel_transcript[0].strand
-                outbed6["thickStart"] = ens_stop
-                not_cds_utrons.append(outbed6)
-        
-        if (options.gtf_out is not None) and (len(CDS_dict) > 0):
-            novel_transcript = list(filter(lambda x: x.feature != "CDS", novel_transcript))
-            novel_transcript.extend(
-                CDS_dict.get(novel_transcript[0].transcript_id,
-                        CDS_dict[list(CDS_dict.keys())[0]])
-            )
-            novel_transcript = sorted(novel_transcript, key = lambda x: x.start)
-            novel_transcript_cds.extend(novel_transcript)      
-
-    with IOTools.open_file(options.outfile, "w") as outf:
-        for line in outlines:
-            outf.write(str(line)+"\n")
-  
-    if options.indivfile is not None:
-        with IOTools.open_file(options.indivfile, "w") as outf2:
-            for line in individuals:
-                outf2.write(str(line)+"\n")
-
-    if options.partfile is not None:
-        with IOTools.open_file(options.partfile, "w") as outf3:
-            for line in partnered:
-                outf3.write(str(line)+"\n")
-        
-    if options.indivpartfile is not None:
-        with IOTools.open_file(options.indivpartfile, "w") as outf4:
-            for line in individualpartnered:
-                outf4.write(str(line)+"\n")
-
-    if options.novelfile is not None:
-        with IOTools.open_file(options.novelfile, "w") as outf5:
-            for line in novel:
-                outf5.write(str(line)+"\n")
-
-    if options.not_cds_file is not None:
-        with IOTools.open_file(options.not_cds_file, "w") as outf6:
-            for line in not_cds_utrons:
-                outf6.write(str(line)+"\n")
-
-    if options.gtf_out is not None:
-        with IOTools.open_file(options.gtf_out, "w") as outf7:
-            for entry in novel_transcript_cds:
-                outf7.write(str(entry)+"\n")
-                
     # write footer and output benchmark information.
     E.stop()
 
@@ -1,5 +1,5 @@
 '''
-get_psi.py - 
+get_psi.py - count reads retaining or splicing out utrons
 ====================================================
 
 :Author:
@@ -8,20 +8,53 @@ get_psi.py -
 Purpose
 -------
 
-.. Overall purpose and function of the script>
+.. Count the reads in a BAM file that retain, splice out or are
+   incompatible with each intron of a BED file of utrons, and the
+   proportion of reads that retain it (PSI).
+
+The utron BED is read from stdin, and may be BED12, in which case each
+block is counted. One line is written for each block with at least one
+read overlapping it, with the columns contig, start, end, name,
+retained, spliced, incompatible, total and psi. Utrons listed under
+several names, as 3UIs shared by many transcripts are, are counted once
+and written once for each name.
+
+By default the reads of each contig are read in a single sweep over the
+regions covered by utrons, so that reads overlapping many utrons are
+only read once. --method=fetch fetches the reads of each utron
+separately and classifies them as earlier versions of this script did.
+Both give the same counts, which --method=check confirms for any BAM
+file by counting with both.
+
+The contigs of a BAM file can be counted in parallel with --threads,
+each worker opening its own handle on the file. The counts of each
+contig are merged back into input order, so the output does not depend
+on the number of threads.
+
+Many BAM files can be given, and counted --processes at a time. Their
+counts can be written as a single long table with a track column, to
+stdout or to a parquet file with --parquet-file, and as tables with a
+row for each utron and a column for each sample of retained reads,
+spliced reads and PSO with --matrix-prefix. The long table is written
+a sample at a time and the tables are built in memory mapped files next
+to the prefix, so the memory used does not grow with the number of
+samples. The track of each BAM file is taken from its name with
+--track-regex.
 
 Usage
 -----
 
-.. Example use case
-
 Example::
 
-   python cgat_script_template.py
+   zcat all_utrons.bed.gz | python get_psi.py sample.bam > sample.psi.tsv
+
+   python get_psi.py -I all_utrons.bed.gz --processes=8
+                     --parquet-file=pso.parquet --matrix-prefix=pso
+                     sorted_bams/*.bam
 
 Type::
 
-   python cgat_script_template.py --help
+   python get_psi.py --help
 
 for command line help.
 
@@ -35,11 +68,536 @@ Command line options
 
 
 import sys
+import os
+import re
+import tempfile
+import multiprocessing
+from collections import OrderedDict
 import cgatcore.experiment as E
 from cgatcore import iotools
 from cgat import Bed
 import pysam
 
+
+def classifyRead(read, utron_start, utron_end):
+    '''Classify a uniquely mapped read overlapping a utron, as the first
+    versions of this script did. This is used by --method=fetch, and
+    kept as the reference that the faster :func:`classifyBlocks` used by
+    the sweep is checked against (see --method=check). Returns the
+    number of times it counts as retaining the utron, splicing it out and
+    as incompatible with it. A read can count more than once: each of its
+    blocks that spans the utron start counts as retaining it, and each
+    gap between blocks that joins its ends as splicing it out.'''
+
+    retained_reads = spliced_reads = incompatible = 0
+
+    try:
+        if 'N' not in read.cigarstring and \
+           read.pos < utron_start and \
+           read.aend > utron_start:
+            return 1, 0, 0
+    except TypeError:
+        E.error(read.to_string())
+        raise
+
+    found = False
+    segments = read.get_blocks()
+
+    for i in range(len(segments) - 1):
+
+        if segments[i][0] < utron_start and\
+           segments[i][1] > utron_start:
+            found = True
+            retained_reads += 1
+        elif abs(segments[i][1] - utron_start) < 3 and\
+             abs(segments[i+1][0] - utron_end) < 3:
+            found = True
+            spliced_reads += 1
+
+    if not found and \
+       segments[-1][0] < utron_start and \
+       segments[-1][1] > utron_start:
+        retained_reads += 1
+    else:
+        incompatible += 1
+
+    return retained_reads, spliced_reads, incompatible
+
+
+def _isCounted(read):
+    '''Is read uniquely mapped? Reads that are not still count towards
+    the total of each utron they overlap.'''
+
+    try:
+        if read.get_tag("NH") > 1:
+            return False
+    except KeyError:
+        pass
+
+    return not read.is_unmapped
+
+
+def fetchInterval(bam, contig, utron_start, utron_end):
+    '''Count the reads of a single utron, fetching the reads overlapping
+    it and one base either side. Returns retained, spliced, incompatible
+    and total counts.'''
+
+    counts = [0, 0, 0, 0]
+    for read in bam.fetch(contig, utron_start - 1, utron_end + 1):
+        counts[3] += 1
+        if _isCounted(read):
+            for i, count in enumerate(classifyRead(read, utron_start,
+                                                   utron_end)):
+                counts[i] += count
+
+    return counts
+
+
+# cigar operations, as in pysam.AlignedSegment.cigartuples, that are
+# aligned blocks, and that consume reference without being aligned
+BLOCK_OPS = frozenset((0, 7, 8))
+GAP_OPS = frozenset((2, 3))
+REF_SKIP = 3
+
+# flag of unmapped reads
+UNMAPPED = 4
+
+
+def readBlocks(read):
+    '''The aligned blocks of a uniquely mapped read, as get_blocks gives
+    them, computed from its cigar tuples, with whether it is spliced (has
+    an N operation) and where its alignment ends. Returns None if the read
+    is unmapped or has an NH tag greater than one.'''
+
+    if read.flag & UNMAPPED:
+        return None
+    if read.has_tag("NH") and read.get_tag("NH") > 1:
+        return None
+
+    cigar = read.cigartuples
+    if not cigar:
+        E.error(read.to_string())
+        raise ValueError("Mapped read %s has no cigar" % read.query_name)
+
+    position = read.reference_start
+    blocks = []
+    spliced = False
+    for op, length in cigar:
+        if op in BLOCK_OPS:
+            blocks.append((position, position + length))
+            position += length
+        elif op in GAP_OPS:
+            if op == REF_SKIP:
+                spliced = True
+            position += length
+
+    return blocks, spliced, position
+
+
+def classifyBlocks(read_start, read_blocks, utron_start, utron_end):
+    '''Classify a read, from its start and the result of
+    :func:`readBlocks`, as :func:`classifyRead` does.'''
+
+    blocks, spliced, read_end = read_blocks
+
+    if not spliced and read_start < utron_start and read_end > utron_start:
+        return 1, 0, 0
+
+    retained_reads = spliced_reads = 0
+    found = False
+    previous_start, previous_end = blocks[0]
+    for block_start, block_end in blocks[1:]:
+        if previous_start < utron_start and previous_end > utron_start:
+            found = True
+            retained_reads += 1
+        elif abs(previous_end - utron_start) < 3 and \
+             abs(block_start - utron_end) < 3:
+            found = True
+            spliced_reads += 1
+        previous_start, previous_end = block_start, block_end
+
+    if not found and \
+       previous_start < utron_start and \
+       previous_end > utron_start:
+        return retained_reads + 1, spliced_reads, 0
+    else:
+        return retained_reads, spliced_reads, 1
+
+
+def sweepContig(bam, contig, intervals):
+    '''Count the reads of each of intervals, a list of (start, end)
+    utrons on contig, in one forward pass over the contig. The fetch
+    regions of the utrons, which include one base either side, are
+    merged into clusters of overlapping regions, and the reads of each
+    cluster fetched once and counted against every utron of the cluster
+    they overlap. The counts are those :func:`fetchInterval` gives, but
+    each read is only decoded once, whatever the number of utrons it
+    overlaps. Returns retained, spliced, incompatible and total counts for
+    each interval, in the order of intervals.'''
+
+    counts = [[0, 0, 0, 0] for interval in intervals]
+    order = sorted(range(len(intervals)), key=lambda i: intervals[i])
+
+    first = 0
+    while first < len(order):
+        region_start = intervals[order[first]][0] - 1
+        region_end = intervals[order[first]][1] + 1
+        last = first + 1
+        while last < len(order) and \
+              intervals[order[last]][0] - 1 < region_end:
+            region_end = max(region_end, intervals[order[last]][1] + 1)
+            last += 1
+
+        # utrons are activated in order of start as reads reach them, and
+        # dropped once reads start beyond their end
+        cluster = order[first:last]
+        waiting = 0
+        active = []
+        expires = region_end
+        for read in bam.fetch(contig, region_start, region_end):
+            read_start = read.reference_start
+
+            # the end htslib uses to decide if a read overlaps a region:
+            # unmapped reads, and reads whose cigar consumes no
+            # reference, cover one base
+            read_end = read.reference_end
+            if read.flag & UNMAPPED or read_end is None or \
+               read_end == read_start:
+                read_end = read_start + 1
+
+            while waiting < len(cluster) and \
+                  intervals[cluster[waiting]][0] - 1 < read_end:
+                active.append(cluster[waiting])
+                expires = min(expires, intervals[cluster[waiting]][1] + 1)
+                waiting += 1
+
+            if read_start >= expires:
+                active = [i for i in active if
+                          intervals[i][1] + 1 > read_start]
+                expires = min([intervals[i][1] + 1 for i in active],
+                              default=region_end)
+
+            read_blocks = False
+            for i in active:
+                utron_start, utron_end = intervals[i]
+                if utron_start - 1 >= read_end:
+                    continue
+                interval_counts = counts[i]
+                interval_counts[3] += 1
+
+                # blocks are only worked out for reads that overlap a
+                # utron, and once however many they overlap
+                if read_blocks is False:
+                    read_blocks = readBlocks(read)
+                if read_blocks is not None:
+                    retained, spliced, incompatible = classifyBlocks(
+                        read_start, read_blocks, utron_start, utron_end)
+                    interval_counts[0] += retained
+                    interval_counts[1] += spliced
+                    interval_counts[2] += incompatible
+
+        first = last
+
+    return counts
+
+
+def countContig(bam, contig, intervals, method="sweep"):
+    '''Count the reads of each of intervals, a list of (start, end)
+    utrons on contig, with :func:`sweepContig`, or with
+    :func:`fetchInterval` if method is "fetch". Returns retained,
+    spliced, incompatible and total counts for each.
+
+    If method is "check", both are used, and a ValueError raised if their
+    counts differ.'''
+
+    if method == "fetch":
+        return [fetchInterval(bam, contig, utron_start, utron_end)
+                for utron_start, utron_end in intervals]
+
+    counts = sweepContig(bam, contig, intervals)
+
+    if method == "check":
+        for interval, interval_counts in zip(intervals, counts):
+            expected = fetchInterval(bam, contig, *interval)
+            if interval_counts != expected:
+                raise ValueError(
+                    "Counts for %s:%i-%i differ: %s from the sweep, %s "
+                    "from fetch" % ((contig,) + interval +
+                                    (interval_counts, expected)))
+
+    return counts
+
+
+def readUtrons(infile):
+    '''Read the utrons of a BED file, one per block of BED12 entries.
+    Utrons are the same if they have the same contig, start, end and
+    strand, and each is only counted once however many names it is
+    listed under. Returns a list of the distinct (contig, start, end) and
+    a list of the (index, name) of each utron in the input, where index
+    is the position of the utron in the first list.'''
+
+    unique = dict()
+    intervals = list()
+    rows = list()
+    for junction in Bed.iterator(infile):
+        for utron_start, utron_end in junction.toIntervals():
+            key = (junction.contig, utron_start, utron_end, junction.strand)
+            if key not in unique:
+                unique[key] = len(intervals)
+                intervals.append(key[:3])
+            rows.append((unique[key], junction.name))
+
+    return intervals, rows
+
+
+def writeCounts(outfile, intervals, rows, counts, track=None):
+    '''Write the counts of each of intervals to outfile, once for each
+    name it was listed under in rows (see :func:`readUtrons`), in input
+    order. Utrons without any reads overlapping them are skipped. If
+    track is given, it is added as a last column.'''
+
+    if track is None:
+        suffix = "\n"
+    else:
+        suffix = "\t%s\n" % track
+
+    for index, name in rows:
+
+        retained_reads, spliced_reads, incompatible, total = map(
+            int, counts[index])
+
+        if total == 0:
+            continue
+
+        if spliced_reads + retained_reads > 0:
+            psi = retained_reads/float(spliced_reads + retained_reads)
+        else:
+            psi = "NA"
+
+        contig, utron_start, utron_end = intervals[index]
+        outfile.write("\t".join(map(str, [contig,
+                                           utron_start,
+                                           utron_end,
+                                           name,
+                                           retained_reads,
+                                           spliced_reads,
+                                           incompatible,
+                                           total,
+                                           psi])) +
+                      suffix)
+
+
+# the columns of the table written by --parquet-file, named as the
+# pipeline has always named them in the database
+TABLE_COLUMNS = ("chr", "start", "end", "transcript_id", "retained",
+                 "spliced", "incompatible", "total", "pso", "track")
+
+# the matrices written by --matrix-prefix
+MATRICES = ("retained", "spliced", "pso")
+
+# state of each worker process, set by _initWorker
+_worker_state = dict()
+
+
+def _initWorker(contigs, method):
+    _worker_state["contigs"] = contigs
+    _worker_state["method"] = method
+    _worker_state["bamfile"] = None
+
+
+def _countContig(task):
+    '''Count the utrons of one contig in one BAM file. Each worker keeps
+    its own handle on the BAM file it last counted.'''
+
+    import numpy
+
+    bamfile, contig = task
+    if _worker_state["bamfile"] != bamfile:
+        if _worker_state["bamfile"] is not None:
+            _worker_state["bam"].close()
+        _worker_state["bam"] = pysam.AlignmentFile(bamfile)
+        _worker_state["bamfile"] = bamfile
+
+    counts = countContig(_worker_state["bam"], contig,
+                         _worker_state["contigs"][contig],
+                         _worker_state["method"])
+    return numpy.array(counts, dtype=numpy.int64).reshape((-1, 4))
+
+
+def iterateSamples(bamfiles, intervals, method="sweep", processes=1):
+    '''Count the reads of each of intervals, a list of (contig, start,
+    end), in each of bamfiles. The work is split into one task for each
+    contig of each BAM file, run by a pool of processes if processes is
+    more than one. Yields an array of retained, spliced, incompatible and
+    total counts, with a row for each interval, for each BAM file in
+    turn.'''
+
+    import numpy
+
+    indices = OrderedDict()
+    for i, (contig, start, end) in enumerate(intervals):
+        indices.setdefault(contig, []).append(i)
+
+    contigs = dict((contig, [intervals[i][1:] for i in contig_indices])
+                   for contig, contig_indices in indices.items())
+
+    # the contigs with most utrons are started first, so that a sample
+    # is not held up by a large contig started last
+    order = sorted(indices, key=lambda contig: len(indices[contig]),
+                   reverse=True)
+    tasks = [(bamfile, contig) for bamfile in bamfiles for contig in order]
+
+    if processes > 1:
+        # utrons are inherited by the forked workers rather than pickled
+        # for each task
+        pool = multiprocessing.get_context("fork").Pool(
+            processes, initializer=_initWorker, initargs=(contigs, method))
+        results = pool.imap(_countContig, tasks)
+    else:
+        _initWorker(contigs, method)
+        results = map(_countContig, tasks)
+
+    for bamfile in bamfiles:
+        counts = numpy.zeros((len(intervals), 4), dtype=numpy.int64)
+        for contig in order:
+            counts[indices[contig]] = next(results)
+        yield counts
+
+    if processes > 1:
+        pool.close()
+        pool.join()
+
+
+def _pso(counts):
+    '''PSO from an array of counts, NaN where no reads are retained or
+    spliced'''
+    import numpy
+
+    informative = counts[:, 0] + counts[:, 1]
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(informative > 0, counts[:, 0] / informative,
+                           numpy.nan)
+
+
+def _tableSchema():
+    import pyarrow as pa
+
+    return pa.schema([("chr", pa.string()),
+                      ("start", pa.int64()),
+                      ("end", pa.int64()),
+                      ("transcript_id", pa.string()),
+                      ("retained", pa.int64()),
+                      ("spliced", pa.int64()),
+                      ("incompatible", pa.int64()),
+                      ("total", pa.int64()),
+                      ("pso", pa.float64()),
+                      ("track", pa.string())])
+
+
+def utronTable(intervals, rows):
+    '''An arrow table of the contig, start, end and name of each utron in
+    rows (see :func:`readUtrons`), to which the counts of each sample are
+    added by :func:`countsTable`.'''
+
+    import pyarrow as pa
+
+    return pa.table([pa.array([intervals[i][0] for i, name in rows],
+                              pa.string()),
+                     pa.array([intervals[i][1] for i, name in rows],
+                              pa.int64()),
+                     pa.array([intervals[i][2] for i, name in rows],
+                              pa.int64()),
+                     pa.array([name for i, name in rows], pa.string())],
+                    names=TABLE_COLUMNS[:4])
+
+
+def countsTable(utrons, index, track, counts):
+    '''The rows of the long table for one sample: the utrons table from
+    :func:`utronTable` with the counts of the utron of each row, found by
+    index, and the track. As in the TSV output, utrons without reads are
+    left out.'''
+
+    import numpy
+    import pyarrow as pa
+
+    row_counts = counts[index]
+    found = row_counts[:, 3] > 0
+    row_counts = row_counts[found]
+    pso = _pso(row_counts)
+
+    table = utrons.filter(pa.array(found))
+    for i, column in enumerate(TABLE_COLUMNS[4:8]):
+        table = table.append_column(column, pa.array(row_counts[:, i]))
+    table = table.append_column(
+        "pso", pa.array(pso, pa.float64(), mask=numpy.isnan(pso)))
+    return table.append_column(
+        "track", pa.array([track] * len(table), pa.string()))
+
+
+def openMatrices(tmpdir, n_utrons, n_samples):
+    '''Make a utron x sample matrix for each of MATRICES, to which the
+    values of each sample are added as it is counted. The matrices are
+    memory mapped files in tmpdir, so that the memory used does not grow
+    with the number of samples.'''
+
+    import numpy
+
+    return dict((matrix, numpy.memmap(
+        os.path.join(tmpdir, "%s.dat" % matrix),
+        dtype=numpy.float64 if matrix == "pso" else numpy.int64,
+        mode="w+", shape=(max(n_utrons, 1), max(n_samples, 1)), order="F"))
+        for matrix in MATRICES)
+
+
+def writeMatrices(prefix, tracks, matrices, intervals, rows,
+                  chunk_size=100000):
+    '''Write tables of the retained and spliced counts and PSO of each
+    utron, one row per name in rows and one column per track, to
+    prefix.retained.tsv.gz, prefix.spliced.tsv.gz and prefix.pso.tsv.gz.
+    matrices holds a utron x sample array for each of MATRICES, as made
+    by :func:`openMatrices`. The tables are written chunk_size rows at a
+    time.'''
+
+    import numpy
+    import pandas
+
+    index = numpy.array([i for i, name in rows], dtype=numpy.int64)
+    names = [name for i, name in rows]
+
+    for matrix in MATRICES:
+        with iotools.open_file("%s.%s.tsv.gz" % (prefix, matrix),
+                               "w") as outf:
+            for start in range(0, max(len(index), 1), chunk_size):
+                chunk = index[start:start + chunk_size]
+                utrons = pandas.DataFrame(
+                    OrderedDict((("contig", [intervals[i][0] for i in chunk]),
+                                 ("start", [intervals[i][1] for i in chunk]),
+                                 ("end", [intervals[i][2] for i in chunk]),
+                                 ("transcript_id",
+                                  names[start:start + chunk_size]))))
+                values = matrices[matrix][chunk, :len(tracks)]
+                pandas.concat([utrons,
+                               pandas.DataFrame(values, columns=tracks)],
+                              axis=1).to_csv(outf, sep="\t", index=False,
+                                             header=start == 0,
+                                             na_rep="NA")
+
+
+def writeParquetMetadata(parquet_file):
+    '''Write the _metadata and _common_metadata files of a dataset made
+    of the single file parquet_file, as dask does, to its directory.'''
+
+    import pyarrow.parquet as pq
+
+    dataset_dir = os.path.dirname(os.path.abspath(parquet_file))
+    metadata = pq.read_metadata(parquet_file)
+    metadata.set_file_path(os.path.basename(parquet_file))
+    schema = metadata.schema.to_arrow_schema()
+    pq.write_metadata(schema, os.path.join(dataset_dir, "_common_metadata"))
+    pq.write_metadata(schema, os.path.join(dataset_dir, "_metadata"),
+                      metadata_collector=[metadata])
+
+
 def main(argv=None):
     """script main.
     parses command line options in sys.argv, unless *argv* is given.
@@ -52,92 +610,111 @@ def main(argv=None):
     parser = E.OptionParser(version="%prog version: $Id$",
                             usage=globals()["__doc__"])
 
-    
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=("sweep", "fetch", "check"),
+                      default="sweep",
+                      help="Count the reads of all utrons on a contig in "
+                           "one pass (sweep), or fetch the reads of each "
+                           "utron separately and classify them as the "
+                           "first versions of this script did (fetch). "
+                           "check counts with both and stops with an "
+                           "error if they differ")
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=1,
+                      help="Number of BAM files to count at once")
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Number of processes to count the contigs of each "
+                           "BAM file with. With --processes, processes x "
+                           "threads processes are used in all")
+    parser.add_option("--track-regex", dest="track_regex", type="string",
+                      default=r"([^/]+)\.bam$",
+                      help="Regular expression whose first group, applied "
+                           "to the name of each BAM file, is the track of "
+                           "that sample")
+    parser.add_option("--parquet-file", dest="parquet_file", type="string",
+                      help="Write a table of the counts of every sample, "
+                           "with a track column, to this parquet file")
+    parser.add_option("--parquet-metadata", dest="parquet_metadata",
+                      action="store_true", default=False,
+                      help="Also write the _metadata and _common_metadata "
+                           "files of a dataset to the directory of "
+                           "--parquet-file")
+    parser.add_option("--matrix-prefix", dest="matrix_prefix",
+                      type="string",
+                      help="Write tables of retained, spliced and PSO, with "
+                           "a row for each utron and a column for each "
+                           "sample, to files starting with this prefix")
 
     # add common options (-h/--help, ...) and parse command line
     (options, args) = E.start(parser, argv=argv)
 
-    bam = pysam.AlignmentFile(args[0])
+    if len(args) == 0:
+        raise ValueError("No BAM files given")
+
+    # tracks are only written with many samples or the table outputs, so
+    # a single BAM file needs no track, whatever it is called
+    need_tracks = (len(args) > 1 or options.parquet_file is not None or
+                   options.matrix_prefix is not None)
+
+    track_regex = re.compile(options.track_regex)
+    tracks = []
+    for bamfile in args:
+        match = track_regex.search(bamfile)
+        if match is not None:
+            tracks.append(match.group(1))
+        elif need_tracks:
+            raise ValueError("Cannot get a track from %s with %s" %
+                             (bamfile, options.track_regex))
+        else:
+            tracks.append(bamfile)
+
+    intervals, rows = readUtrons(options.stdin)
+    E.info("Read %i utrons, %i distinct" % (len(rows), len(intervals)))
+
+    samples = iterateSamples(args, intervals, options.method,
+                             options.processes * options.threads)
+
+    if options.parquet_file is not None:
+        import numpy
+        import pyarrow.parquet as pq
+        utrons = utronTable(intervals, rows)
+        index = numpy.array([i for i, name in rows], dtype=numpy.int64)
+        writer = pq.ParquetWriter(options.parquet_file, _tableSchema())
+
+    if options.matrix_prefix is not None:
+        matrix_dir = tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(options.matrix_prefix)))
+        matrices = openMatrices(matrix_dir.name, len(intervals), len(args))
+
+    for sample, (track, counts) in enumerate(zip(tracks, samples)):
+
+        if options.parquet_file is not None:
+            writer.write_table(countsTable(utrons, index, track, counts))
+
+        if options.matrix_prefix is not None:
+            matrices["retained"][:, sample] = counts[:, 0]
+            matrices["spliced"][:, sample] = counts[:, 1]
+            matrices["pso"][:, sample] = _pso(counts)
+
+        # a single sample is written to stdout as it always has been, many
+        # with their track added, unless written to other outputs
+        if options.parquet_file is None and options.matrix_prefix is None:
+            writeCounts(options.stdout, intervals, rows, counts,
+                        track if len(args) > 1 else None)
+
+        E.info("Counted %s" % track)
+
+    if options.parquet_file is not None:
+        writer.close()
+        if options.parquet_metadata:
+            writeParquetMetadata(options.parquet_file)
+
+    if options.matrix_prefix is not None:
+        writeMatrices(options.matrix_prefix, tracks, matrices, intervals,
+                      rows)
+        del matrices
+        matrix_dir.cleanup()
 
-    outlines = list()
-    
-    for junction in Bed.iterator(options.stdin):
-        for utron_start, utron_end in junction.toIntervals():
-            reads = bam.fetch(junction.contig,
-                              utron_start - 1,
-                              utron_end + 1)
-            retained_reads = 0
-            spliced_reads = 0
-            incompatible = 0
-        
-            reads = list(reads)
-            total = len(reads)
-        
-            if len(reads) == 0:
-                continue
-        
-            for read in reads:
-
-                try:
-                    if read.get_tag("NH") > 1:
-                        continue
-                except KeyError:
-                    pass
-
-            
-                if read.is_unmapped:
-                    continue
-            
-                found = False
-            
-                try:
-                    if 'N' not in read.cigarstring and \
-                    read.pos < utron_start and \
-                    read.aend > utron_start:
-                     found = True
-                     retained_reads += 1
-                     continue
-                except TypeError:
-                    E.error(print(read.to_string()))
-                    raise 
-            
-                segments = read.get_blocks()
-
-                for i in range(len(segments) - 1):
-
-                    if segments[i][0] < utron_start and\
-                       segments[i][1] > utron_start:
-                        found = True
-                        retained_reads += 1
-                    elif abs(segments[i][1] - utron_start) < 3 and\
-                         abs(segments[i+1][0]  - utron_end) < 3:
-                        found = True
-                        spliced_reads += 1
-
-                if not found and \
-                   segments[-1][0] < utron_start and \
-                   segments[-1][1] > utron_start:
-                    retained_reads += 1
-                else:
-                    incompatible += 1
-                
-
-            if spliced_reads + retained_reads > 0:
-                psi = retained_reads/float(spliced_reads + retained_reads)
-            else:
-                psi = "NA"
-            
-            options.stdout.write("\t".join(map(str, [junction.contig,
-                                                 utron_start,
-                                                 utron_end,
-                                                 junction.name,
-                                                 retained_reads,
-                                                 spliced_reads,
-                                                 incompatible,
-                                                 total,
-                                                 psi])) +
-                             "\n")
-     
     # write footer and output benchmark information.
     E.stop()
 
@@ -0,0 +1,408 @@
+'''
+junction_pso.py - PSO of utrons from featureCounts junction counts
+====================================================
+
+:Author:
+:Tags: Python
+
+Purpose
+-------
+
+.. Compute the percent spliced out (PSO) of utrons in many samples from
+   the junction counts of featureCounts -J and read counts over the
+   utron starts, rather than by classifying the reads of each utron
+   with get_psi.py.
+
+Spliced reads are taken from the .jcounts file of each sample. As in
+get_psi.py, a junction splices a utron if its ends are within two bases
+of the utron's, and it does not start after the start of the utron.
+
+Retained reads are the reads running through the start of each utron,
+the boundary of the exon before it. They are counted by featureCounts
+with a SAF file, written by --method=saf, that has a two base feature
+across each utron start. Run featureCounts with --minOverlap 2 so that
+only reads covering both bases are counted::
+
+   featureCounts -F SAF -a boundaries.saf -O --minOverlap 2
+                 -o sample1.boundaries.tsv sample1.bam
+
+The counts of the utrons of all samples are then computed at once
+(--method=pso, the default) with pandas joins. The jcounts files are
+given as arguments, and the boundary counts of each are found by
+replacing --jcounts-suffix with --boundaries-suffix. Output is as
+get_psi.py's: a long table to stdout or to --parquet-file, and utron x
+sample tables with --matrix-prefix. featureCounts does not record the
+reads that are incompatible with a utron, so the incompatible and total
+columns are missing, and utrons are left out of the long table where no
+read is retained or spliced.
+
+featureCounts counts reads differently from get_psi.py: with -p it
+counts fragments rather than reads, it counts overlap with aligned bases
+only, and reports N operations as junctions where get_psi.py also takes
+deletions near the utron ends as splicing. With --compare-bam, the
+utrons are also counted with get_psi.py in the BAM files given, normally
+a few of the samples, and the agreement of the two for each measure in
+each of those samples is written to --agreement-file.
+
+Usage
+-----
+
+Example::
+
+   zcat all_utrons.bed.gz | python junction_pso.py --method=saf
+       > boundaries.saf
+
+   zcat all_utrons.bed.gz |
+   python junction_pso.py --matrix-prefix=pso.dir/junction_pso
+                          --compare-bam=sorted_bams/sample1_possorted.bam
+                          --agreement-file=pso.dir/agreement.tsv
+                          featureCounts.dir/*.tsv.jcounts
+
+Type::
+
+   python junction_pso.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import re
+import sys
+from collections import OrderedDict
+import cgatcore.experiment as E
+import cgatcore.iotools as IOTools
+
+from get_psi import readUtrons, iterateSamples, utronTable, _tableSchema, \
+    writeMatrices, TABLE_COLUMNS
+from splice_evidence import joinJunctions
+
+AGREEMENT_COLUMNS = ("track", "measure", "utrons", "pearson", "spearman",
+                     "identical", "mean_abs_difference",
+                     "max_abs_difference")
+
+
+def writeBoundarySAF(outfile, intervals):
+    '''Write a SAF file with a feature across the start of each of
+    intervals: the last base of the exon before it and its first base.'''
+
+    outfile.write("\t".join(("GeneID", "Chr", "Start", "End", "Strand"))
+                  + "\n")
+    for contig, start in sorted(set((contig, start)
+                                    for contig, start, end in intervals)):
+        # SAF is 1-based and closed, so the bases start - 1 and start are
+        # start to start + 1
+        outfile.write("%s:%i\t%s\t%i\t%i\t+\n" % (
+            contig, start, contig, start, start + 1))
+
+
+def readJunctionCounts(jcounts_file):
+    '''The count of each junction in a featureCounts .jcounts file as a
+    pandas DataFrame of contig, start, end and count, where start and end
+    are the 0-based, half-open bounds of the intron.'''
+
+    import pandas
+
+    junctions = pandas.read_csv(
+        jcounts_file, sep="\t", usecols=[2, 3, 5, 6, 8], header=0,
+        names=["contig", "site1", "contig2", "site2", "count"],
+        dtype={"contig": str, "contig2": str})
+
+    # featureCounts gives the last base of the exon before the junction
+    # and the first base of the exon after it, both 1-based. Junctions
+    # between contigs, from chimeric reads, are not introns
+    junctions = junctions[junctions["contig"] == junctions["contig2"]]
+    junctions = pandas.DataFrame(OrderedDict((
+        ("contig", junctions["contig"]),
+        ("start", junctions["site1"]),
+        ("end", junctions["site2"] - 1),
+        ("count", junctions["count"]))))
+
+    return junctions.groupby(["contig", "start", "end"],
+                             as_index=False)["count"].sum()
+
+
+def readBoundaryCounts(boundaries_file):
+    '''The reads counted by featureCounts over the features of the SAF
+    from :func:`writeBoundarySAF`, as a pandas DataFrame of contig,
+    start and count.'''
+
+    import pandas
+
+    boundaries = pandas.read_csv(
+        boundaries_file, sep="\t", comment="#", usecols=[1, 2, 6],
+        header=0, names=["contig", "site", "count"], dtype={"contig": str})
+
+    return pandas.DataFrame(OrderedDict((
+        ("contig", boundaries["contig"]),
+        ("start", boundaries["site"]),
+        ("count", boundaries["count"]))))
+
+
+def junctionCounts(intervals, tracks, jcounts_files, boundaries_files):
+    '''Retained and spliced reads of each of intervals, a list of (contig,
+    start, end), in each sample. Returns two numpy arrays with a row for
+    each interval and a column for each of tracks.'''
+
+    import numpy
+    import pandas
+
+    introns = pandas.DataFrame(intervals, columns=["contig", "start", "end"])
+    introns["index"] = range(len(introns))
+
+    # all samples are joined at once, as junction x sample and boundary x
+    # sample tables
+    junctions = pandas.concat(
+        [readJunctionCounts(jcounts_file).set_index(
+            ["contig", "start", "end"])["count"].rename(track)
+         for track, jcounts_file in zip(tracks, jcounts_files)],
+        axis=1).fillna(0).reset_index()
+    spliced = joinJunctions(introns, junctions).reindex(
+        index=range(len(introns)), columns=tracks).fillna(0)
+
+    boundaries = pandas.concat(
+        [readBoundaryCounts(boundaries_file).set_index(
+            ["contig", "start"])["count"].rename(track)
+         for track, boundaries_file in zip(tracks, boundaries_files)],
+        axis=1).fillna(0)
+    retained = boundaries.reindex(
+        pandas.MultiIndex.from_arrays([introns["contig"], introns["start"]]))
+    if retained.isnull().values.any():
+        raise ValueError(
+            "%i utron starts are not in the boundary counts. Were they "
+            "counted with the SAF of these utrons?" %
+            retained.isnull().any(axis=1).sum())
+
+    return (retained.values.astype(numpy.int64),
+            spliced.values.astype(numpy.int64))
+
+
+def _pso(retained, spliced):
+    '''PSO of arrays of retained and spliced reads, NaN where there are
+    neither'''
+    import numpy
+
+    informative = retained + spliced
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(informative > 0, retained / informative,
+                           numpy.nan)
+
+
+def countsTable(utrons, index, track, retained, spliced):
+    '''The rows of the long table for one sample, as
+    :func:`get_psi.countsTable` gives them, but with the incompatible and
+    total columns missing and without the utrons where no reads are
+    retained or spliced.'''
+
+    import numpy
+    import pyarrow as pa
+
+    retained = retained[index]
+    spliced = spliced[index]
+    found = (retained + spliced) > 0
+    retained = retained[found]
+    spliced = spliced[found]
+    pso = _pso(retained, spliced)
+
+    table = utrons.filter(pa.array(found))
+    table = table.append_column("retained", pa.array(retained))
+    table = table.append_column("spliced", pa.array(spliced))
+    for column in TABLE_COLUMNS[6:8]:
+        table = table.append_column(
+            column, pa.nulls(len(table), pa.int64()))
+    table = table.append_column(
+        "pso", pa.array(pso, pa.float64(), mask=numpy.isnan(pso)))
+    return table.append_column(
+        "track", pa.array([track] * len(table), pa.string()))
+
+
+def agreement(track, retained, spliced, counts):
+    '''Compare the retained and spliced reads and PSO of each utron in one
+    sample with counts, those of get_psi.py. Utrons for which neither
+    has reads are left out. Returns a row of AGREEMENT_COLUMNS for each
+    measure.'''
+
+    import numpy
+    import pandas
+
+    informative = (retained + spliced + counts[:, 0] + counts[:, 1]) > 0
+    measures = OrderedDict((
+        ("retained", (retained, counts[:, 0])),
+        ("spliced", (spliced, counts[:, 1])),
+        ("pso", (_pso(retained, spliced), _pso(counts[:, 0], counts[:, 1])))))
+
+    rows = []
+    for measure, (values, expected) in measures.items():
+        values = values[informative].astype(numpy.float64)
+        expected = expected[informative].astype(numpy.float64)
+        compared = ~(numpy.isnan(values) | numpy.isnan(expected))
+        # a PSO that only one of the two has counts as a difference
+        identical = ((values == expected) |
+                     (numpy.isnan(values) & numpy.isnan(expected)))
+
+        pair = pandas.DataFrame({"values": values[compared],
+                                 "expected": expected[compared]})
+        ranks = pair.rank()
+        difference = numpy.abs(pair["values"] - pair["expected"])
+        rows.append((track, measure, int(informative.sum()),
+                     pair["values"].corr(pair["expected"]),
+                     ranks["values"].corr(ranks["expected"]),
+                     identical.mean() if len(identical) else numpy.nan,
+                     difference.mean(), difference.max()))
+
+    return rows
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=("pso", "saf"), default="pso",
+                      help="Write a SAF of the utron starts, to count "
+                           "retained reads with featureCounts (saf), or "
+                           "compute the PSO of the utrons from the counts "
+                           "of each sample (pso)")
+    parser.add_option("--jcounts-suffix", dest="jcounts_suffix",
+                      type="string", default=".tsv.jcounts",
+                      help="Suffix of the jcounts files. The rest of the "
+                           "name of each is its track")
+    parser.add_option("--boundaries-suffix", dest="boundaries_suffix",
+                      type="string", default=".boundaries.tsv.gz",
+                      help="Suffix of the featureCounts output for the "
+                           "utron starts of each sample")
+    parser.add_option("--parquet-file", dest="parquet_file", type="string",
+                      help="Write a table of the counts of every sample, "
+                           "with a track column, to this parquet file")
+    parser.add_option("--matrix-prefix", dest="matrix_prefix",
+                      type="string",
+                      help="Write tables of retained, spliced and PSO, with "
+                           "a row for each utron and a column for each "
+                           "sample, to files starting with this prefix")
+    parser.add_option("--compare-bam", dest="compare_bams", type="string",
+                      action="append", default=[],
+                      help="Also count the utrons with get_psi.py in this "
+                           "BAM file, whose track must be one of the "
+                           "samples, and compare. Can be given more than "
+                           "once")
+    parser.add_option("--track-regex", dest="track_regex", type="string",
+                      default=r"([^/]+)\.bam$",
+                      help="Regular expression whose first group, applied "
+                           "to the name of each --compare-bam, is its "
+                           "track")
+    parser.add_option("--agreement-file", dest="agreement_file",
+                      type="string",
+                      help="Write the agreement with get_psi.py to this "
+                           "file rather than to the log")
+    parser.add_option("--processes", dest="processes", type="int",
+                      default=1,
+                      help="Number of processes to count the --compare-bam "
+                           "files with")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.start(parser, argv=argv)
+
+    intervals, rows = readUtrons(options.stdin)
+    E.info("Read %i utrons, %i distinct" % (len(rows), len(intervals)))
+
+    if options.method == "saf":
+        writeBoundarySAF(options.stdout, intervals)
+        E.stop()
+        return
+
+    if len(args) == 0:
+        raise ValueError("No jcounts files given")
+
+    tracks = []
+    boundaries_files = []
+    for jcounts_file in args:
+        if not jcounts_file.endswith(options.jcounts_suffix):
+            raise ValueError("%s does not end with %s" %
+                             (jcounts_file, options.jcounts_suffix))
+        prefix = jcounts_file[:-len(options.jcounts_suffix)]
+        tracks.append(os.path.basename(prefix))
+        boundaries_files.append(prefix + options.boundaries_suffix)
+
+    retained, spliced = junctionCounts(intervals, tracks, args,
+                                       boundaries_files)
+    E.info("Counted %i samples" % len(tracks))
+
+    if options.parquet_file is not None:
+        import numpy
+        import pyarrow.parquet as pq
+        utrons = utronTable(intervals, rows)
+        index = numpy.array([i for i, name in rows], dtype=numpy.int64)
+        writer = pq.ParquetWriter(options.parquet_file, _tableSchema())
+        for column, track in enumerate(tracks):
+            writer.write_table(countsTable(utrons, index, track,
+                                           retained[:, column],
+                                           spliced[:, column]))
+        writer.close()
+
+    if options.matrix_prefix is not None:
+        matrices = dict((
+            ("retained", list(retained.T)),
+            ("spliced", list(spliced.T)),
+            ("pso", [_pso(retained[:, column], spliced[:, column])
+                     for column in range(len(tracks))])))
+        writeMatrices(options.matrix_prefix, tracks, matrices, intervals,
+                      rows)
+
+    if options.parquet_file is None and options.matrix_prefix is None:
+        for column, track in enumerate(tracks):
+            for index, name in rows:
+                retained_reads = int(retained[index, column])
+                spliced_reads = int(spliced[index, column])
+                if retained_reads + spliced_reads == 0:
+                    continue
+                psi = retained_reads/float(retained_reads + spliced_reads)
+                contig, start, end = intervals[index]
+                options.stdout.write("\t".join(map(str, (
+                    contig, start, end, name, retained_reads,
+                    spliced_reads, "NA", "NA", psi, track))) + "\n")
+
+    if options.compare_bams:
+        track_regex = re.compile(options.track_regex)
+        compare_tracks = []
+        for bamfile in options.compare_bams:
+            match = track_regex.search(bamfile)
+            if match is None or match.group(1) not in tracks:
+                raise ValueError("%s is not the BAM file of any sample" %
+                                 bamfile)
+            compare_tracks.append(match.group(1))
+
+        if options.agreement_file is not None:
+            outfile = IOTools.open_file(options.agreement_file, "w")
+        else:
+            outfile = options.stdlog
+            outfile.write("# agreement with get_psi.py\n")
+        outfile.write("\t".join(AGREEMENT_COLUMNS) + "\n")
+
+        samples = iterateSamples(options.compare_bams, intervals,
+                                 processes=options.processes)
+        for track, counts in zip(compare_tracks, samples):
+            column = tracks.index(track)
+            for row in agreement(track, retained[:, column],
+                                 spliced[:, column], counts):
+                outfile.write("\t".join(map(str, row)) + "\n")
+            E.info("Compared %s with get_psi.py" % track)
+
+        if options.agreement_file is not None:
+            outfile.close()
+
+    # write footer and output benchmark information.
+    E.stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
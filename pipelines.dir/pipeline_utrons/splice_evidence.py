@@ -0,0 +1,362 @@
+'''
+splice_evidence.py - index the splicing evidence of a BAM file
+====================================================
+
+:Author:
+:Tags: Python
+
+Purpose
+-------
+
+.. Record the junctions and the reads running through splice sites in
+   a BAM file once, so that the PSO of any set of introns can be
+   computed from them without reading the BAM file again.
+
+With --method=build, each BAM file given is read once and two parquet
+tables are written for it:
+
+<prefix>.junctions.parquet
+   contig, start and end of every intron (N operation) of a uniquely
+   mapped read, and the number of reads splicing it.
+
+<prefix>.boundaries.parquet
+   contig and position of every junction boundary, and the number of
+   uniquely mapped reads running through it. A read runs through a
+   position if one of its aligned blocks, or for an unspliced read its
+   whole alignment, starts before and ends after it.
+
+Boundaries are the starts and ends of the junctions found in the sample.
+Introns of a GTF given with --boundaries-gtf are added, so that introns
+that no read in this sample splices still have their retained reads
+counted.
+
+With --method=pso (the default), the utrons of a BED file read from
+stdin are looked up in the indexes given, much as get_psi.py counts
+them: a read retains a utron if it runs through its start, and splices
+it if it does not, but has a junction within two bases of both of its
+ends. One line is written for each utron in each sample, with the
+columns contig, start, end, name, retained, spliced, psi and track.
+retained and psi are NA when the start of a utron is not an indexed
+boundary.
+
+Reads are counted as by get_psi.py: reads with an NH tag greater than
+one and unmapped reads are skipped. get_psi.py also counts incompatible
+and total reads, which are not recorded here.
+
+The counts are not always the same as get_psi.py's. Only N operations
+are junctions here, whereas get_psi.py treats any gap between the aligned
+blocks of a spliced read as splicing, so a spliced read with a deletion
+(D operation) whose ends are within two bases of those of a utron counts
+as splicing it there but not here. Use get_psi.py --method=check, rather
+than this script, to check the counts of get_psi.py itself.
+
+Usage
+-----
+
+Example::
+
+   python splice_evidence.py --method=build
+                             --boundaries-gtf=agg-agg-agg.gtf.gz
+                             --output-prefix=evidence.dir/sample1
+                             sample1.bam
+
+   zcat all_utrons.bed.gz |
+   python splice_evidence.py evidence.dir/sample1 evidence.dir/sample2
+
+Type::
+
+   python splice_evidence.py --help
+
+for command line help.
+
+Command line options
+--------------------
+
+'''
+
+import os
+import sys
+from array import array
+from collections import Counter, defaultdict
+import cgatcore.experiment as E
+import cgatcore.iotools as IOTools
+import pysam
+
+from get_psi import readUtrons, UNMAPPED, BLOCK_OPS, REF_SKIP
+from splice_site_index import SpliceSiteIndex
+
+# get_psi.py counts a read as splicing a utron if its ends are within
+# this distance of the junction's
+TOLERANCE = 2
+
+
+def _readEvidence(read):
+    '''The intervals through which a uniquely mapped read runs, and its
+    junctions. Returns None for reads that get_psi.py does not count.'''
+
+    if read.flag & UNMAPPED:
+        return None
+    if read.has_tag("NH") and read.get_tag("NH") > 1:
+        return None
+
+    position = read.reference_start
+    blocks = []
+    junctions = []
+    for op, length in read.cigartuples:
+        if op in BLOCK_OPS:
+            blocks.append((position, position + length))
+        elif op == REF_SKIP:
+            junctions.append((position, position + length))
+        elif op != 2:
+            continue
+        position += length
+
+    # get_psi.py counts unspliced reads as running through any position
+    # inside their alignment, including deletions
+    if not junctions:
+        blocks = [(read.reference_start, position)]
+
+    return blocks, junctions
+
+
+def indexContig(bam, contig, boundaries=()):
+    '''Count the junctions of contig, and the reads running through the
+    ends of each and through each of boundaries. Returns the counts of
+    each junction, as (start, end, count), and of each boundary, as
+    (position, count), both sorted.'''
+
+    import numpy
+
+    starts = array("l")
+    ends = array("l")
+    junctions = Counter()
+
+    for read in bam.fetch(contig):
+        evidence = _readEvidence(read)
+        if evidence is None:
+            continue
+        blocks, read_junctions = evidence
+        for block_start, block_end in blocks:
+            starts.append(block_start)
+            ends.append(block_end)
+        for junction in read_junctions:
+            junctions[junction] += 1
+
+    positions = set(boundaries)
+    for start, end in junctions:
+        positions.add(start)
+        positions.add(end)
+    positions = numpy.array(sorted(positions), dtype=numpy.int64)
+
+    # the blocks of a read do not overlap, so each read running through
+    # a position is one block starting before and not ending at or
+    # before it
+    starts = numpy.sort(numpy.frombuffer(starts, dtype=numpy.int_))
+    ends = numpy.sort(numpy.frombuffer(ends, dtype=numpy.int_))
+    read_through = (numpy.searchsorted(starts, positions, side="left") -
+                    numpy.searchsorted(ends, positions, side="right"))
+
+    junctions = [(start, end, count) for (start, end), count in
+                 sorted(junctions.items())]
+
+    return junctions, list(zip(positions.tolist(), read_through.tolist()))
+
+
+def buildIndex(bamfile, output_prefix, boundaries=None):
+    '''Index the junctions and boundaries of every contig of bamfile,
+    writing them to output_prefix.junctions.parquet and
+    output_prefix.boundaries.parquet. boundaries, a dict of positions
+    for each contig, are added to the junction ends of each contig.'''
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if boundaries is None:
+        boundaries = dict()
+
+    junction_columns = defaultdict(list)
+    boundary_columns = defaultdict(list)
+
+    bam = pysam.AlignmentFile(bamfile)
+    for contig in bam.references:
+        junctions, read_through = indexContig(bam, contig,
+                                              boundaries.get(contig, ()))
+        E.debug("%s: %i junctions, %i boundaries" % (
+            contig, len(junctions), len(read_through)))
+
+        junction_columns["contig"].extend([contig] * len(junctions))
+        for column, values in zip(("start", "end", "count"),
+                                  zip(*junctions)):
+            junction_columns[column].extend(values)
+
+        boundary_columns["contig"].extend([contig] * len(read_through))
+        for column, values in zip(("position", "read_through"),
+                                  zip(*read_through)):
+            boundary_columns[column].extend(values)
+
+    bam.close()
+
+    junction_schema = pa.schema([("contig", pa.dictionary(pa.int32(),
+                                                          pa.string())),
+                                 ("start", pa.int64()),
+                                 ("end", pa.int64()),
+                                 ("count", pa.int64())])
+    boundary_schema = pa.schema([("contig", pa.dictionary(pa.int32(),
+                                                          pa.string())),
+                                 ("position", pa.int64()),
+                                 ("read_through", pa.int64())])
+
+    for suffix, columns, schema in (
+            ("junctions", junction_columns, junction_schema),
+            ("boundaries", boundary_columns, boundary_schema)):
+        table = pa.Table.from_pydict(
+            dict((field.name, pa.array(columns[field.name], field.type))
+                 for field in schema),
+            schema=schema)
+        pq.write_table(table, "%s.%s.parquet" % (output_prefix, suffix))
+        E.info("Wrote %i %s for %s" % (len(table), suffix, bamfile))
+
+
+def loadBoundaries(gtffile):
+    '''The intron starts and ends of a GTF, as a set for each contig.'''
+
+    with IOTools.open_file(gtffile) as inf:
+        index = SpliceSiteIndex.fromGTF(inf)
+    boundaries = defaultdict(set)
+    for positions in (index.intron_starts, index.intron_ends):
+        for (contig, strand), contig_positions in positions.items():
+            boundaries[contig].update(contig_positions)
+
+    return boundaries
+
+
+def joinJunctions(introns, junctions):
+    '''Sum the count columns of junctions, a pandas DataFrame with the
+    contig, start and end of each junction, over the junctions that
+    get_psi.py counts as splicing each of introns, a DataFrame of contig,
+    start, end and index. Returns the sums indexed by the index of each
+    intron that any junction splices.'''
+
+    import pandas
+
+    # each junction matches at most one of the shifted copies of an
+    # intron, so summing over the copies counts each read once. A read
+    # whose junction starts after the intron start runs through it, and
+    # get_psi.py counts it as retaining rather than splicing the intron
+    shifted = pandas.concat(
+        [introns.assign(start=introns["start"] + start_offset,
+                        end=introns["end"] + end_offset)
+         for start_offset in range(-TOLERANCE, 1)
+         for end_offset in range(-TOLERANCE, TOLERANCE + 1)])
+    spliced = shifted.merge(junctions, on=["contig", "start", "end"])
+    return spliced.drop(columns=["contig", "start", "end"]).groupby(
+        "index").sum()
+
+
+def evidencePSO(intervals, index_prefix):
+    '''Retained and spliced reads for each of intervals, a list of
+    (contig, start, end), from the index at index_prefix. Returns a
+    pandas DataFrame with a row for each interval, in order. retained is
+    missing where the start of an interval is not an indexed boundary.'''
+
+    import pandas
+
+    junctions = pandas.read_parquet(index_prefix + ".junctions.parquet")
+    boundaries = pandas.read_parquet(index_prefix + ".boundaries.parquet")
+    for table in (junctions, boundaries):
+        table["contig"] = table["contig"].astype(str)
+
+    introns = pandas.DataFrame(intervals, columns=["contig", "start", "end"])
+    introns["index"] = range(len(introns))
+
+    spliced = joinJunctions(introns, junctions)["count"]
+
+    retained = introns.merge(
+        boundaries, how="left", left_on=["contig", "start"],
+        right_on=["contig", "position"])
+    retained = retained.set_index("index")["read_through"]
+
+    result = pandas.DataFrame(index=introns["index"])
+    result["retained"] = retained.reindex(result.index)
+    result["spliced"] = spliced.reindex(result.index).fillna(0).astype(int)
+    return result
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    # setup command line parser
+    parser = E.OptionParser(version="%prog version: $Id$",
+                            usage=globals()["__doc__"])
+
+    parser.add_option("--method", dest="method", type="choice",
+                      choices=("pso", "build"), default="pso",
+                      help="Build an index from a BAM file (build), or "
+                           "compute the PSO of utrons read from stdin "
+                           "from indexes (pso)")
+    parser.add_option("--output-prefix", dest="output_prefix",
+                      type="string",
+                      help="build: prefix of the index files. By default "
+                           "the name of the BAM file without .bam")
+    parser.add_option("--boundaries-gtf", dest="boundaries_gtf",
+                      type="string",
+                      help="build: also count reads running through the "
+                           "intron ends of this GTF")
+
+    # add common options (-h/--help, ...) and parse command line
+    (options, args) = E.start(parser, argv=argv)
+
+    if options.method == "build":
+        if len(args) != 1:
+            raise ValueError("build takes a single BAM file")
+
+        if options.boundaries_gtf is not None:
+            boundaries = loadBoundaries(options.boundaries_gtf)
+        else:
+            boundaries = None
+
+        if options.output_prefix is None:
+            if args[0].endswith(".bam"):
+                options.output_prefix = args[0][:-len(".bam")]
+            else:
+                options.output_prefix = args[0]
+
+        buildIndex(args[0], options.output_prefix, boundaries)
+
+    else:
+        intervals, rows = readUtrons(options.stdin)
+        E.info("Read %i utrons, %i distinct" % (len(rows), len(intervals)))
+
+        for index_prefix in args:
+            track = os.path.basename(index_prefix)
+            counts = evidencePSO(intervals, index_prefix)
+            retained = counts["retained"].tolist()
+            spliced = counts["spliced"].tolist()
+
+            for index, name in rows:
+                contig, start, end = intervals[index]
+                if retained[index] != retained[index]:
+                    row_retained = psi = "NA"
+                else:
+                    row_retained = int(retained[index])
+                    if row_retained + spliced[index] > 0:
+                        psi = row_retained / float(row_retained +
+                                                   spliced[index])
+                    else:
+                        psi = "NA"
+                options.stdout.write("\t".join(map(str, (
+                    contig, start, end, name, row_retained, spliced[index],
+                    psi, track))) + "\n")
+
+            E.info("Computed PSO for %s" % track)
+
+    # write footer and output benchmark information.
+    E.stop()
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
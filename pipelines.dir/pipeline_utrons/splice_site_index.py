@@ -0,0 +1,181 @@
+'''
+splice_site_index.py
+====================================================
+
+:Release: $1.0$
+:Date: |today|
+:Tags: Python
+
+Purpose
+-------
+
+.. A genome-wide, strand aware index of the donor and acceptor positions
+   of annotated introns, and of the introns inside annotated coding
+   regions.
+
+Introns are in the half-open, forward strand coordinates used by
+:func:`cgat.GTF.toIntronIntervals`, so the donor of an intron on the "+"
+strand is its start and on the "-" strand its end. The index stores the
+two ends of each intron as given and leaves the interpretation to the
+caller.
+
+Usage
+-----
+
+Example::
+
+   import cgatcore.iotools as IOTools
+   from splice_site_index import SpliceSiteIndex
+
+   index = SpliceSiteIndex.fromGTF(IOTools.open_file("geneset.gtf.gz"))
+   index.isNovel("chr1", "+", (1000, 2000))
+   index.isNotCDS("chr1", "+", (1000, 2000))
+
+An index can also be filled transcript by transcript with
+:meth:`SpliceSiteIndex.add` by scripts that already have the introns
+and CDS bounds of each transcript to hand.
+
+'''
+
+from collections import defaultdict
+
+import cgat.Intervals as Intervals
+
+
+def gtfAttribute(text, name):
+    '''Get the value of the attribute name from the text of a GTF line,
+    or of its attribute field, without parsing it. Only whole attribute
+    names are matched, so that transcript_id does not find
+    ref_transcript_id. Returns None if the attribute is missing.'''
+
+    key = name + ' "'
+    start = text.find(key)
+    while start != -1:
+        if start == 0 or text[start - 1] in "\t; ":
+            start += len(key)
+            return text[start:text.find('"', start)]
+        start = text.find(key, start + 1)
+
+    return None
+
+
+class SpliceSiteIndex(object):
+    '''The start and end positions of annotated introns and of annotated
+    introns inside a CDS, held as one set of each per contig and strand.'''
+
+    def __init__(self):
+        self.intron_starts = defaultdict(set)
+        self.intron_ends = defaultdict(set)
+        self.cds_intron_starts = defaultdict(set)
+        self.cds_intron_ends = defaultdict(set)
+
+    def add(self, contig, strand, introns, cds=None):
+        '''Add the introns of one transcript, a list of (start, end) that
+        is read twice, so not an iterator. If cds, the (start, end) bounds
+        of its coding region, is given, introns that lie strictly inside it
+        are also added as CDS introns.'''
+
+        key = (contig, strand)
+        starts = self.intron_starts[key]
+        ends = self.intron_ends[key]
+        for start, end in introns:
+            starts.add(start)
+            ends.add(end)
+
+        if cds is None:
+            return
+
+        cds_start, cds_end = cds
+        cds_starts = self.cds_intron_starts[key]
+        cds_ends = self.cds_intron_ends[key]
+        for start, end in introns:
+            if start > cds_start and end < cds_end:
+                cds_starts.add(start)
+                cds_ends.add(end)
+
+    def isNovel(self, contig, strand, intron):
+        '''Are neither of the ends of intron the end of an annotated
+        intron on this contig and strand?'''
+
+        key = (contig, strand)
+        return (intron[0] not in self.intron_starts.get(key, ()) and
+                intron[1] not in self.intron_ends.get(key, ()))
+
+    def isNotCDS(self, contig, strand, intron):
+        '''Are neither of the ends of intron the end of an annotated
+        intron inside a CDS on this contig and strand?'''
+
+        key = (contig, strand)
+        return (intron[0] not in self.cds_intron_starts.get(key, ()) and
+                intron[1] not in self.cds_intron_ends.get(key, ()))
+
+    def iterateSites(self):
+        '''Iterate over the contigs and strands of the index, giving
+        (contig, strand, intron starts, intron ends, CDS intron starts,
+        CDS intron ends) for each, for storing the index.'''
+
+        for key in self.intron_starts:
+            contig, strand = key
+            yield (contig, strand,
+                   self.intron_starts[key], self.intron_ends[key],
+                   self.cds_intron_starts.get(key, ()),
+                   self.cds_intron_ends.get(key, ()))
+
+    def addSites(self, contig, strand, starts, ends, cds_starts=(),
+                 cds_ends=()):
+        '''Add intron start and end positions to the index directly, as
+        given by :meth:`iterateSites`, rather than transcript by
+        transcript.'''
+
+        key = (contig, strand)
+        self.intron_starts[key].update(starts)
+        self.intron_ends[key].update(ends)
+        if cds_starts or cds_ends:
+            self.cds_intron_starts[key].update(cds_starts)
+            self.cds_intron_ends[key].update(cds_ends)
+
+    def __len__(self):
+        return sum(len(starts) for starts in self.intron_starts.values())
+
+    @classmethod
+    def fromGTF(cls, infile):
+        '''Build an index from the exon and CDS lines of a GTF, which need
+        not be sorted. Lines are split rather than parsed in full, as only
+        the coordinates and transcript of each feature are needed.'''
+
+        exons = defaultdict(list)
+        cds = dict()
+        locations = dict()
+
+        for line in infile:
+            if line.startswith("#"):
+                continue
+            fields = line.split("\t", 8)
+            feature = fields[2]
+            if feature != "exon" and feature != "CDS":
+                continue
+
+            transcript_id = gtfAttribute(fields[8], "transcript_id")
+            if transcript_id is None:
+                continue
+
+            # GTF is 1-based and closed, the index 0-based and half-open
+            # like cgat.GTF
+            interval = (int(fields[3]) - 1, int(fields[4]))
+
+            if feature == "exon":
+                exons[transcript_id].append(interval)
+                locations[transcript_id] = (fields[0], fields[6])
+            elif transcript_id in cds:
+                cds[transcript_id] = (min(cds[transcript_id][0], interval[0]),
+                                      max(cds[transcript_id][1], interval[1]))
+            else:
+                cds[transcript_id] = interval
+
+        index = cls()
+        for transcript_id, transcript_exons in exons.items():
+            contig, strand = locations[transcript_id]
+            introns = Intervals.complement(Intervals.combine(transcript_exons))
+            index.add(contig, strand, introns, cds.get(transcript_id))
+
+        return index
@@ -261,36 +261,42 @@ def filterGTFs(infiles, outfile):
  
     
 # ---------------------------------------------------
-@follows(mkdir("utron_beds.dir"), mkdir("utron_gtfs.dir"), classifyTranscripts)
-@subdivide(filterGTFs,
-           regex("(.+)/(.+).filtered.gtf.gz"),
-           add_inputs(PARAMS["annotations_filtered_reference_gtf"],
-                      r"\1/\2.filtered.class.gz"),
-           [r"utron_beds.dir/\2.all_utrons.bed.gz",
-            r"utron_beds.dir/\2.indevidual_utrons.bed.gz",
-            r"utron_beds.dir/\2.partnered_utrons.bed.gz",
-            r"utron_beds.dir/\2.novel_utrons.bed.gz",
-            r"utron_beds.dir/\2.no_cds_utrons.bed.gz",
-            r"utron_gtfs.dir/\2.gtf.gz"])
-def find_utrons(infiles, outfiles):
+FIND_UTRONS_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "pipeline_utrons", "find_utrons.py")
 
-    infile, reference, classfile = infiles
-    job_memory="48G"
 
-    all_out, all_bed6_out, part_out, novel_out, no_cds_out, gtf_out = outfiles
+def runFindUtrons(infile, reference, classfile, outfiles, options=""):
+    '''Run find_utrons.py on one assembly. outfiles are the all,
+    individual, partnered, novel and no CDS utron BEDs, the GTF of 3UI
+    transcripts and, optionally, the table of 3UIs.'''
+
+    # job_memory is per slot. The workers are forked after the reference
+    # is loaded and share it, so the 48G of a single process is split
+    # between them rather than asked for by each
+    job_threads = PARAMS.get("find_utrons_processes", 4)
+    job_memory = "%iG" % -(-48 // job_threads)
+
+    all_out, all_bed6_out, part_out, novel_out, no_cds_out, gtf_out = \
+        outfiles[:6]
+
+    if len(outfiles) > 6:
+        options += " --table-out=%s" % outfiles[6]
+
+    index_format = PARAMS.get("find_utrons_index", 0)
+    if index_format:
+        options += " --index-output=%s" % index_format
+
+    if PARAMS.get("find_utrons_memo", 0):
+        options += " --memo-file=reference_cache.dir/find_utrons.memo"
 
     track = P.snip(all_out, ".all_utrons.bed.gz")
-    current_file = __file__ 
-    pipeline_path = os.path.abspath(current_file)
-    pipeline_directory = os.path.dirname(pipeline_path)
-    script_path = "pipeline_utrons/find_utrons.py"
-    full_utron_path = os.path.join(pipeline_directory, script_path)  
-    statement = '''cgat gtf2gtf -I %(infile)s
-                             --method=sort
-                             --sort-order=gene+transcript
-                              -L %(track)s.log
-                 | python %(full_utron_path)s 
+    full_utron_path = FIND_UTRONS_SCRIPT
+    statement = '''python %(full_utron_path)s
+                             -I %(infile)s
                              --reffile=%(reference)s
+                             --reference-cache=reference_cache.dir
+                             --lazy-reference
+                             --processes=%(job_threads)s
                              --class-file=%(classfile)s
                              --outfile %(all_out)s
                              --indivfile %(all_bed6_out)s
@@ -298,13 +304,145 @@ def find_utrons(infiles, outfiles):
                              --novel-file=%(novel_out)s
                              --not-cds-outfile=%(no_cds_out)s
                              --gtf-out-file=%(gtf_out)s
+                             --summary-file=%(track)s.summary.tsv
+                             %(options)s
                               -L %(track)s.log'''
 
     P.run(statement)
 
 
 # ---------------------------------------------------
-@transform(find_utrons,
+@follows(mkdir("utron_beds.dir"), mkdir("utron_gtfs.dir"),
+         mkdir("reference_cache.dir"), classifyTranscripts)
+@subdivide(filterGTFs,
+           regex("(.+)/(agg-agg-agg).filtered.gtf.gz"),
+           add_inputs(PARAMS["annotations_filtered_reference_gtf"],
+                      r"\1/\2.filtered.class.gz"),
+           [r"utron_beds.dir/\2.all_utrons.bed.gz",
+            r"utron_beds.dir/\2.indevidual_utrons.bed.gz",
+            r"utron_beds.dir/\2.partnered_utrons.bed.gz",
+            r"utron_beds.dir/\2.novel_utrons.bed.gz",
+            r"utron_beds.dir/\2.no_cds_utrons.bed.gz",
+            r"utron_gtfs.dir/\2.gtf.gz",
+            r"utron_beds.dir/\2.utrons.tsv.gz"])
+def find_agg_utrons(infiles, outfiles):
+    '''Find utrons in the merge of all assemblies. The table of 3UIs
+    written here is projected onto the other assemblies if
+    find_utrons_project is set.'''
+
+    infile, reference, classfile = infiles
+    runFindUtrons(infile, reference, classfile, outfiles)
+
+
+# with find_utrons_project set, transcripts with an "=" match in the
+# merge of all assemblies take its 3UIs, and only the rest are classified
+AGG_UTRONS_TABLE = "utron_beds.dir/agg-agg-agg.utrons.tsv.gz"
+
+if PARAMS.get("find_utrons_project", 0):
+    FIND_UTRONS_INPUTS = [PARAMS["annotations_filtered_reference_gtf"],
+                          r"\1/\2.filtered.class.gz",
+                          r"\1/\2.filtered.matches.tsv.gz"]
+    FIND_UTRONS_DEPENDS = [find_agg_utrons, "run_trmap2tsv"]
+else:
+    FIND_UTRONS_INPUTS = [PARAMS["annotations_filtered_reference_gtf"],
+                          r"\1/\2.filtered.class.gz"]
+    FIND_UTRONS_DEPENDS = [find_agg_utrons]
+
+
+# ---------------------------------------------------
+@active_if(PARAMS.get("find_utrons_batch", 0))
+@follows(*FIND_UTRONS_DEPENDS)
+@merge(filterGTFs, "utron_beds.dir/find_utrons.batch.tsv")
+def find_utrons_batch(infiles, outfile):
+    '''If find_utrons_batch is set, find the utrons of all the filtered
+    assemblies other than agg-agg-agg in one job, loading the reference
+    once, rather than one job per assembly. find_utrons then has nothing
+    left to do.'''
+
+    with iotools.open_file(outfile, "w") as outf:
+        outf.write("infile\tclass_file\toutput_prefix\tgtf\t"
+                   "individual_partnered\ttable\ttranscript_map\n")
+        for infile in infiles:
+            track = P.snip(os.path.basename(infile), ".filtered.gtf.gz")
+            if track == "agg-agg-agg":
+                continue
+            classfile = P.snip(infile, ".gtf.gz") + ".class.gz"
+            if PARAMS.get("find_utrons_project", 0):
+                transcript_map = P.snip(infile, ".gtf.gz") + ".matches.tsv.gz"
+            else:
+                transcript_map = ""
+            outf.write("\t".join([infile,
+                                  classfile,
+                                  os.path.join("utron_beds.dir", track),
+                                  os.path.join("utron_gtfs.dir",
+                                               track + ".gtf.gz"),
+                                  "",
+                                  "",
+                                  transcript_map]) + "\n")
+
+    reference = PARAMS["annotations_filtered_reference_gtf"]
+    # job_memory is per slot. The workers are forked after the reference
+    # is loaded and share it, so the 48G of a single process is split
+    # between them rather than asked for by each
+    job_threads = PARAMS.get("find_utrons_processes", 4)
+    job_memory = "%iG" % -(-48 // job_threads)
+
+    if PARAMS.get("find_utrons_project", 0):
+        project_options = "--project-table=%s" % AGG_UTRONS_TABLE
+    else:
+        project_options = ""
+
+    index_format = PARAMS.get("find_utrons_index", 0)
+    if index_format:
+        project_options += " --index-output=%s" % index_format
+
+    if PARAMS.get("find_utrons_memo", 0):
+        project_options += " --memo-file=reference_cache.dir/find_utrons.memo"
+
+    full_utron_path = FIND_UTRONS_SCRIPT
+    statement = '''python %(full_utron_path)s
+                             --batch-file=%(outfile)s
+                             --reffile=%(reference)s
+                             --reference-cache=reference_cache.dir
+                             --lazy-reference
+                             --processes=%(job_threads)s
+                             %(project_options)s
+                             --summary-file=%(outfile)s.summary.tsv
+                              -L %(outfile)s.log'''
+
+    P.run(statement)
+
+
+# ---------------------------------------------------
+@follows(find_utrons_batch)
+@subdivide(filterGTFs,
+           regex("(.+)/(?!agg-agg-agg\.)([^/]+).filtered.gtf.gz"),
+           add_inputs(*FIND_UTRONS_INPUTS),
+           [r"utron_beds.dir/\2.all_utrons.bed.gz",
+            r"utron_beds.dir/\2.indevidual_utrons.bed.gz",
+            r"utron_beds.dir/\2.partnered_utrons.bed.gz",
+            r"utron_beds.dir/\2.novel_utrons.bed.gz",
+            r"utron_beds.dir/\2.no_cds_utrons.bed.gz",
+            r"utron_gtfs.dir/\2.gtf.gz"])
+def find_utrons(infiles, outfiles):
+
+    if PARAMS.get("find_utrons_batch", 0):
+        # outputs were written by find_utrons_batch
+        return
+
+    if PARAMS.get("find_utrons_project", 0):
+        infile, reference, classfile, transcript_map = infiles
+        options = "--project-table=%s --transcript-map=%s" % (
+            AGG_UTRONS_TABLE, transcript_map)
+    else:
+        infile, reference, classfile = infiles
+        options = ""
+
+    runFindUtrons(infile, reference, classfile, outfiles, options)
+
+
+# ---------------------------------------------------
+@transform([find_agg_utrons, find_utrons],
            suffix(".bed.gz"),
            ".ids.gz")
 def getUtronIds(infile, outfile):
@@ -383,7 +521,7 @@ def export():
 
 # ---------------------------------------------------
 @follows(mkdir("annotation.dir"))
-@transform(find_utrons, 
+@transform([find_agg_utrons, find_utrons],
            regex(".+/(.+-.+-.+)\.(.+)_utrons.bed.gz"), 
            r"annotation.dir/\1_\2_splice_sites.txt")
 def identify_splice_sites(infile, outfile):
@@ -117,7 +117,27 @@ Pipeline output
 2. Salmon quantification files in .sf format are generted in quantification.dir.
 3. A file with the number of reads in each exon
 4. A file with the number of reads cross each junction
-5. A file with the percent spliced out for every utron/3UI
+5. The percent spliced out for every utron/3UI in every sample, as a
+   table in the parquet database and as utron x sample tables in pso.dir.
+   All samples are counted in a single job, using pso_processes (default
+   8) processes.
+   If pso_evidence_index is set, the junctions and the reads running
+   through splice sites in each sample are also indexed once, in
+   splice_evidence.dir, and the PSO of the utrons computed from them.
+   The PSO of a changed utron set can be recomputed from these indexes
+   with pipeline_utrons/splice_evidence.py, without reading the BAMs.
+   If pso_junction_counts is set, the PSO is also computed from the
+   featureCounts junction counts and a count of the reads over each
+   utron start, in pso.dir/junction_pso.*, with its agreement with the
+   above for the first pso_junction_compare (default 2) samples in
+   pso.dir/junction_pso.agreement.tsv. This does not classify the reads
+   of each utron, so is quicker for large cohorts.
+   If pso_bam_cache is set, the reads within pso_bam_cache_flank
+   (default 1000) bases of the utrons are cut out of each sample into
+   bam_cache.dir/<hash of the utron BED>, listed in
+   bam_cache.dir/manifest.tsv, and the PSO is counted from these. They
+   can be used for recounting or looking at the reads of the same utrons
+   without the whole genome BAM files.
 6. A file with the TPM and expression fraction of every transcript in every
    sample. 
    
@@ -309,6 +329,12 @@ def create_index(table, columns):
 STRINGTIE_QUANT_FILES=["i_data.ctab", "e_data.ctab", "t_data.ctab",
                        "i2t.ctab", "e2t.ctab"]
 
+# the utrons of the assembly, made by pipeline_utrons_annotate. Tasks that
+# read it take it as an input, so that they are re-run when it changes
+UTRON_BED = os.path.join(PARAMS["input_utron_beds"],
+                         "%s.all_utrons.bed.gz" %
+                         os.path.basename(PARAMS["input_gtf"]).split(".")[0])
+
 
 #-----------------------------------------------------------------------------
 @follows(mkdir("expression.dir"))
@@ -489,40 +515,152 @@ def sortAndIndexBams(infile, outfile):
     P.run(statement)
     
     
-@follows(mkdir("pso.dir"))
-@transform(quantifyWithSalmon,
-           regex("quantification.dir/(.+?)\.(.+)/quant.sf"),
-           inputs([r"sorted_bams/\1_possorted.bam",
-                   os.path.join(PARAMS["input_utron_beds"],
-                                "%s.all_utrons.bed.gz" %
-                                os.path.basename(PARAMS["input_gtf"]).split(".")[0])]),
-           r"pso.dir/\1_all_utrons.pso.tsv.gz")
+@active_if(PARAMS.get("pso_bam_cache", False))
+@follows(mkdir("bam_cache.dir"))
+@merge([sortAndIndexBams, UTRON_BED], "bam_cache.dir/slice.log")
+def sliceBams(infiles, outfile):
+    '''Cut the reads around the utrons, pso_bam_cache_flank (default 1000)
+    bases either side, out of every sample into small indexed BAM files in
+    bam_cache.dir/<hash of the utron BED>. Samples already sliced for the
+    same utrons are not sliced again, but a new utron BED is sliced
+    afresh.'''
+
+    script = os.path.join(PARAMS["project_src"],
+                          "pipeline_utrons/bam_cache.py")
+    bedfile, = [infile for infile in infiles if infile.endswith(".bed.gz")]
+    bamfiles = " ".join(infile for infile in infiles
+                        if infile.endswith(".bam"))
+    flank = PARAMS.get("pso_bam_cache_flank", 1000)
+    job_threads = PARAMS.get("pso_processes", 8)
+
+    statement = '''python %(script)s
+                       -I %(bedfile)s
+                       --cache-dir=bam_cache.dir
+                       --flank=%(flank)s
+                       --processes=%(job_threads)s
+                       -L %(outfile)s
+                       %(bamfiles)s'''
+
+    P.run(statement, job_memory="4G")
+
+
+@follows(mkdir("pso.dir"), sliceBams)
+@merge([sortAndIndexBams, UTRON_BED], "pso.dir/pso.load")
 def calculatePSO(infiles, outfile):
-    '''Calculate the percent spliced out for the utron intervals'''
+    '''Calculate the percent spliced out for the utron intervals in all
+    samples in one job, which reads the utrons once and counts samples in
+    parallel. The long table is written straight to the parquet database
+    and utron x sample tables of retained and spliced reads and PSO to
+    pso.dir.
+
+    The table is written to a temporary directory and only replaces the
+    one in the database, and outfile is only touched, once get_psi.py has
+    finished, so that a failed job leaves the old table in place and is
+    re-run'''
     
     script = os.path.join(PARAMS["project_src"], "pipeline_utrons/get_psi.py")
-    bamfile, bedfile = infiles
+    bedfile, = [infile for infile in infiles if infile.endswith(".bed.gz")]
+    bamfiles = " ".join(infile for infile in infiles
+                        if infile.endswith(".bam"))
+
+    if PARAMS.get("pso_bam_cache", False):
+        # count the slices of each sample made by sliceBams instead. The
+        # lookup is written to a file, rather than substituted into the
+        # command, so that the job fails if any sample has no slice
+        lookup_file = P.snip(outfile, ".load") + ".bams.txt"
+        lookup = '''python %s
+                          --method=lookup
+                          -I %s
+                          --cache-dir=bam_cache.dir
+                          --flank=%s
+                          -L bam_cache.dir/lookup.log
+                          %s > %s &&''' % (
+                              os.path.join(PARAMS["project_src"],
+                                           "pipeline_utrons/bam_cache.py"),
+                              bedfile,
+                              PARAMS.get("pso_bam_cache_flank", 1000),
+                              bamfiles,
+                              lookup_file)
+        bamfiles = "$(cat %s)" % lookup_file
+    else:
+        lookup = ""
+
+    outpath = os.path.join(PARAMS["database_parquet_root"], "pso")
+    tmppath = outpath + ".tmp"
+    logfile = P.snip(outfile, ".load") + ".log"
+    job_threads = PARAMS.get("pso_processes", 8)
     
     statement = '''
+                    %(lookup)s
+                    rm -rf %(tmppath)s &&
+                    mkdir -p %(tmppath)s &&
                     python %(script)s 
                        -I %(bedfile)s
-                       -S %(outfile)s
-                       -L %(outfile)s.log
-                       %(bamfile)s'''
+                       --processes=%(job_threads)s
+                       --track-regex='([^/]+)_possorted.bam$'
+                       --parquet-file=%(tmppath)s/part.0.parquet
+                       --parquet-metadata
+                       --matrix-prefix=pso.dir/pso
+                       -L %(logfile)s
+                       %(bamfiles)s &&
+                    rm -rf %(outpath)s &&
+                    mv %(tmppath)s %(outpath)s &&
+                    touch %(outfile)s'''
                        
     P.run(statement, job_memory="6G")
    
 
-@merge(calculatePSO, "pso.dir/pso.load")
-def load_PSO(infiles, outfile):
-    
-    toParquet(infiles=infiles,
-              outfile=outfile,
-              no_header=True,
-              col_names="chr,start,end,transcript_id,retained,spliced,incompatible,total,pso",
-              regex_filename='.+/(.+)_all_utrons')
+@active_if(PARAMS.get("pso_evidence_index", False))
+@follows(mkdir("splice_evidence.dir"))
+@transform(sortAndIndexBams,
+           regex("sorted_bams/(.+)_possorted.bam"),
+           r"splice_evidence.dir/\1.junctions.parquet")
+def buildSpliceEvidence(infile, outfile):
+    '''Record the junctions of each sample, and the reads running through
+    each junction end and each intron end of the assembly, once. The PSO
+    of any set of introns can then be computed without reading the BAM
+    files again'''
+
+    script = os.path.join(PARAMS["project_src"],
+                          "pipeline_utrons/splice_evidence.py")
+    prefix = P.snip(outfile, ".junctions.parquet")
+
+    statement = '''python %(script)s
+                       --method=build
+                       --boundaries-gtf=%(input_gtf)s
+                       --output-prefix=%(prefix)s
+                       -L %(prefix)s.log
+                       %(infile)s'''
+
+    P.run(statement, job_memory="8G")
+
+
+@active_if(PARAMS.get("pso_evidence_index", False))
+@follows(mkdir("pso.dir"))
+@merge([buildSpliceEvidence, UTRON_BED], "pso.dir/evidence_pso.tsv.gz")
+def evidencePSO(infiles, outfile):
+    '''Compute the PSO of the utrons in every sample from the splice
+    evidence indexes, without reading the BAM files. This is re-run, from
+    the same indexes, when the utron BED changes. Deletions are not
+    junctions in the indexes, so reads splicing a utron with a deletion
+    rather than an intron are not counted, unlike in calculatePSO'''
+
+    script = os.path.join(PARAMS["project_src"],
+                          "pipeline_utrons/splice_evidence.py")
+    bedfile, = [infile for infile in infiles if infile.endswith(".bed.gz")]
+    prefixes = " ".join(P.snip(infile, ".junctions.parquet")
+                        for infile in infiles
+                        if infile.endswith(".junctions.parquet"))
+
+    statement = '''python %(script)s
+                       -I %(bedfile)s
+                       -S %(outfile)s
+                       -L %(outfile)s.log
+                       %(prefixes)s'''
+
+    P.run(statement, job_memory="8G")
+
 
-    
 @follows(mkdir("featureCounts.dir"))
 @subdivide(quantifyWithSalmon, 
            regex("quantification.dir/(.+?)\.(.+)/quant.sf"),
@@ -553,6 +691,97 @@ def countExonsAndJunctions(infiles, outfiles):
     P.run(statement)
 
 
+@active_if(PARAMS.get("pso_junction_counts", False))
+@follows(mkdir("featureCounts.dir"))
+@transform(UTRON_BED,
+           regex(".+"),
+           "featureCounts.dir/utron_boundaries.saf")
+def makeUtronBoundariesSAF(infile, outfile):
+    '''Make a SAF file with a two base feature across the start of every
+    utron, to count the reads that retain each with featureCounts'''
+
+    script = os.path.join(PARAMS["project_src"],
+                          "pipeline_utrons/junction_pso.py")
+
+    statement = '''python %(script)s
+                       --method=saf
+                       -I %(infile)s
+                       -S %(outfile)s
+                       -L %(outfile)s.log'''
+
+    P.run(statement)
+
+
+@active_if(PARAMS.get("pso_junction_counts", False))
+@follows(makeUtronBoundariesSAF)
+@transform(quantifyWithSalmon,
+           regex("quantification.dir/(.+?)\.(.+)/quant.sf"),
+           inputs([r"sorted_bams/\1_sorted.bam",
+                   "featureCounts.dir/utron_boundaries.saf"]),
+           r"featureCounts.dir/\1.boundaries.tsv.gz")
+def countUtronBoundaries(infiles, outfile):
+    '''Count the reads running through the start of every utron. Reads
+    are counted as in countExonsAndJunctions, so that they can be compared
+    with the junction counts'''
+
+    bamfile, saffile = infiles
+    outfile = P.snip(outfile, ".gz")
+    statement = '''featureCounts -a %(saffile)s
+                                 -F SAF
+                                 -o %(outfile)s
+                                 -O
+                                 --minOverlap 2
+                                 -p
+                                 %(bamfile)s &> %(outfile)s.log &&
+                                 gzip %(outfile)s
+                                 '''
+
+    P.run(statement, job_memory="4G")
+
+
+@active_if(PARAMS.get("pso_junction_counts", False))
+@follows(mkdir("pso.dir"), sortAndIndexBams)
+@merge([countExonsAndJunctions, countUtronBoundaries, UTRON_BED],
+       "pso.dir/junction_pso.load")
+def junctionPSO(infiles, outfile):
+    '''Calculate the PSO of the utrons in all samples from the junction
+    counts of countExonsAndJunctions and the reads counted over utron
+    starts, without reading the BAM files. The first
+    pso_junction_compare (default 2) samples are also counted with
+    get_psi.py, and the agreement of the two is written to
+    pso.dir/junction_pso.agreement.tsv'''
+
+    script = os.path.join(PARAMS["project_src"],
+                          "pipeline_utrons/junction_pso.py")
+    bedfile, = [infile for infile in infiles if infile.endswith(".bed.gz")]
+    jcounts = " ".join(infile for infile in infiles
+                       if infile.endswith(".tsv.jcounts"))
+
+    compare = sorted(glob.glob("sorted_bams/*_possorted.bam"))
+    compare = compare[:PARAMS.get("pso_junction_compare", 2)]
+    compare = " ".join("--compare-bam=%s" % bamfile for bamfile in compare)
+
+    outpath = os.path.join(PARAMS["database_parquet_root"], "junction_pso")
+    agreement = P.snip(outfile, ".load") + ".agreement.tsv"
+    job_threads = PARAMS.get("pso_processes", 8)
+
+    statement = '''
+                    rm -rf %(outpath)s &&
+                    mkdir -p %(outpath)s &&
+                    python %(script)s
+                       -I %(bedfile)s
+                       --processes=%(job_threads)s
+                       --track-regex='([^/]+)_possorted.bam$'
+                       %(compare)s
+                       --agreement-file=%(agreement)s
+                       --parquet-file=%(outpath)s/part.0.parquet
+                       --matrix-prefix=pso.dir/junction_pso
+                       -L %(outfile)s
+                       %(jcounts)s'''
+
+    P.run(statement, job_memory="8G")
+
+
 @collate(countExonsAndJunctions,
          regex("featureCounts.dir/(.+)\.tsv\.(gz|jcounts)"),
          r"featureCounts.dir/featurecounts.\2.load",
@@ -843,7 +1072,9 @@ def load_rmats_per_junction(infiles, outfile):
 @follows(run_rmats_post,
          load_exon_counts,
          load_rmats_ri,
-         load_PSO,
+         calculatePSO,
+         evidencePSO,
+         junctionPSO,
          load_rmats_per_junction)
 def requant():
     pass            
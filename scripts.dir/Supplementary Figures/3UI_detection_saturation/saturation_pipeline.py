@@ -139,6 +139,7 @@ def filterGTFs(infiles, outfile):
 ### run find_utrons.py to detect the various classes of 3UIs ###
 ################################################################
     
+@follows(mkdir("saturation/reference_cache.dir"))
 @subdivide(filterGTFs,
            regex("(.+)/(.+).filtered.gtf.gz"),
            add_inputs(PARAMS["annotations_filtered_reference_gtf"],
@@ -155,15 +156,21 @@ def find_utrons(infiles, outfiles):
 
     all_out, all_bed6_out, part_out, novel_out, no_cds_out = outfiles
 
+    if PARAMS.get("find_utrons_memo", 0):
+        memo_options = ("--memo-file="
+                        "saturation/reference_cache.dir/find_utrons.memo")
+    else:
+        memo_options = ""
+
     track = P.snip(all_out, ".all_utrons.bed.gz")
     current_file = __file__ 
     full_utron_path = "/shared/sudlab1/General/projects/stem_utrons/pipelines/pipeline_utrons/pipeline_utrons/find_utrons.py"
-    statement = '''cgat gtf2gtf -I %(infile)s
-                             --method=sort
-                             --sort-order=gene+transcript
-                              -L %(track)s.log
-                 | python %(full_utron_path)s 
+    statement = '''python %(full_utron_path)s
+                             -I %(infile)s
                              --reffile=%(reference)s
+                             --reference-cache=saturation/reference_cache.dir
+                             --lazy-reference
+                             %(memo_options)s
                              --class-file=%(classfile)s
                              --outfile %(all_out)s
                              --indivfile %(all_bed6_out)s